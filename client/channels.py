@@ -0,0 +1,39 @@
+import tkinter as tk
+from tkinter import simpledialog, messagebox
+from network import send_json
+
+DEFAULT = "global"
+
+def join_channel_popup(client):
+    name = simpledialog.askstring("Join channel", "Channel name:", parent=client.root)
+    if name and name.strip():
+        send_json(client, {"type": "join", "channel": name.strip()})
+
+def leave_current_channel(client):
+    if client.channel == DEFAULT:
+        return messagebox.showinfo("Channels", f"#{DEFAULT} cannot be left from here.")
+    send_json(client, {"type": "leave", "channel": client.channel})
+
+def request_list_channels(client):
+    send_json(client, {"type": "list_channels"})
+
+def show_channels_list(client, m):
+    win = tk.Toplevel(client.root)
+    win.title("Channels")
+    win.geometry("300x300")
+    win.grab_set()
+    listbox = tk.Listbox(win)
+    listbox.pack(fill="both", expand=True, padx=6, pady=6)
+    joined = set(m.get("joined", []))
+    for c in m.get("channels", []):
+        mark = " *" if c["name"] in joined else ""
+        listbox.insert("end", f"#{c['name']} ({c['members']}){mark}")
+
+    def join_selected():
+        sel = listbox.curselection()
+        if sel:
+            send_json(client, {"type": "join", "channel": listbox.get(sel[0]).split(" ")[0][1:]})
+            win.destroy()
+
+    tk.Button(win, text="Join", command=join_selected).pack(side="left", padx=4, pady=4)
+    tk.Button(win, text="Close", command=win.destroy).pack(side="right", padx=4, pady=4)
@@ -0,0 +1,178 @@
+# Wire framing shared by server and client (keep server/framing.py and
+# client/framing.py identical).
+#
+# "json": one JSON object per line, the default and what old peers speak.
+# "bin1": 5-byte header (body length, message type id) followed by the
+#         remaining fields as compact JSON; negotiated with a "hello" command.
+#
+# Either may be wrapped in zlib stream compression, also negotiated with
+# "hello": after hello_ok each write is one block, a 5-byte header (flag,
+# length) and the bytes raw or deflated.
+import json
+import struct
+import zlib
+
+JSON_LINES, BINARY = "json", "bin1"
+PROTOCOLS = (JSON_LINES, BINARY)
+HEADER = struct.Struct("!IB")
+COMPRESSIONS = ("zlib",)
+BLOCK = struct.Struct("!BI")
+RAW, DEFLATED = 0, 1
+COMPRESS_MIN = 32  # smaller writes, like a pong, gain nothing from deflate and go raw
+
+TYPES = [
+    "hello", "hello_ok", "error", "ping", "pong",
+    "register", "register_ok", "login", "login_ok",
+    "reset_password", "reset_ok", "delete_account", "delete_ok",
+    "chat", "private_chat", "add_contact", "add_contact_ok",
+    "remove_contact", "remove_contact_ok", "list_contacts", "list_contacts_ok",
+    "get_code", "your_code", "online_status", "stats", "stats_ok",
+    "join", "join_ok", "leave", "leave_ok", "list_channels", "list_channels_ok",
+    "history", "history_ok", "resume", "resume_ok",
+    "mailbox", "mailbox_ack", "resume_session",
+    "reconnect",
+]
+TYPE_IDS = {t: i + 1 for i, t in enumerate(TYPES)}
+INVALID = {"type": "error", "message": "Invalid JSON"}
+
+class FrameTooLarge(ValueError):
+    pass
+
+def encode(obj, proto=JSON_LINES):
+    if proto == JSON_LINES:
+        return (json.dumps(obj) + "\n").encode()
+    tid = TYPE_IDS.get(obj.get("type"), 0)
+    body = {k: v for k, v in obj.items() if k != "type"} if tid else obj
+    data = json.dumps(body, separators=(",", ":"), ensure_ascii=False).encode() if body else b""
+    return HEADER.pack(len(data), tid) + data
+
+def decode(tid, body):
+    try:
+        obj = json.loads(body) if body else {}
+    except ValueError:
+        return dict(INVALID)
+    if not isinstance(obj, dict):
+        return dict(INVALID)
+    if tid:
+        obj["type"] = TYPES[tid - 1] if tid <= len(TYPES) else None
+    return obj
+
+class Frame:
+    # One outgoing message, encoded at most once per protocol so a fan-out
+    # to many connections pays for a single json.dumps per encoding.
+    __slots__ = ("obj", "cache")
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.cache = {}
+
+    def encode(self, proto):
+        data = self.cache.get(proto)
+        if data is None:
+            data = self.cache[proto] = encode(self.obj, proto)
+        return data
+
+class Framer:
+    # Incremental decoder over a bytearray. Only newly fed bytes are scanned
+    # for a delimiter, and consumed bytes are dropped once per feed().
+    # proto may be switched between messages; the rest of the buffer is
+    # then parsed with the new framing. With max_size set, a frame longer
+    # than that raises FrameTooLarge instead of being buffered until it ends.
+    def __init__(self, proto=JSON_LINES, max_size=None):
+        self.proto = proto
+        self.max_size = max_size
+        self.buf = bytearray()
+        self.pos = 0
+        self.scan = 0
+
+    def feed(self, data):
+        if self.pos:
+            del self.buf[:self.pos]
+            self.scan -= self.pos
+            self.pos = 0
+        self.buf += data
+
+    def take_rest(self):
+        # The unparsed bytes, removed; for when the stream changes under us.
+        rest = bytes(self.buf[self.pos:])
+        del self.buf[:]
+        self.pos = self.scan = 0
+        return rest
+
+    def next(self):
+        while True:
+            if self.proto == JSON_LINES:
+                i = self.buf.find(b"\n", self.scan)
+                if i < 0:
+                    self.scan = len(self.buf)
+                    if self.max_size and self.scan - self.pos > self.max_size:
+                        raise FrameTooLarge(self.scan - self.pos)
+                    return None
+                line = self.buf[self.pos:i]
+                self.pos = self.scan = i + 1
+                if not line.strip():
+                    continue
+                return decode(0, line)
+            if len(self.buf) - self.pos < HEADER.size:
+                return None
+            n, tid = HEADER.unpack_from(self.buf, self.pos)
+            if self.max_size and n > self.max_size:
+                raise FrameTooLarge(n)
+            end = self.pos + HEADER.size + n
+            if len(self.buf) < end:
+                return None
+            body = self.buf[self.pos + HEADER.size:end]
+            self.pos = self.scan = end
+            return decode(tid, body)
+
+    def messages(self):
+        while True:
+            msg = self.next()
+            if msg is None:
+                return
+            yield msg
+
+class Deflater:
+    # Outgoing side of a compressed stream. All blocks share one deflate
+    # context, so keys and names repeated from earlier frames cost next to
+    # nothing, and each is sync-flushed so the peer can decode it at once.
+    def __init__(self, min_size=None, level=6):
+        self.min_size = COMPRESS_MIN if min_size is None else min_size
+        self.z = zlib.compressobj(level)
+
+    def pack(self, data):
+        if len(data) < self.min_size:
+            return BLOCK.pack(RAW, len(data)) + data
+        body = self.z.compress(data) + self.z.flush(zlib.Z_SYNC_FLUSH)
+        return BLOCK.pack(DEFLATED, len(body)) + body
+
+class Inflater:
+    # Incoming side: reassembles blocks and returns the bytes they carry.
+    # With max_size set, a block that is or inflates to more than that
+    # raises FrameTooLarge.
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.z = zlib.decompressobj()
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+        out, pos = [], 0
+        while len(self.buf) - pos >= BLOCK.size:
+            flag, n = BLOCK.unpack_from(self.buf, pos)
+            if self.max_size and n > self.max_size:
+                raise FrameTooLarge(n)
+            end = pos + BLOCK.size + n
+            if len(self.buf) < end:
+                break
+            body = bytes(self.buf[pos + BLOCK.size:end])
+            pos = end
+            if flag == RAW:
+                out.append(body)
+                continue
+            data = self.z.decompress(body, self.max_size or 0)
+            if self.z.unconsumed_tail:
+                raise FrameTooLarge(len(data))
+            out.append(data)
+        del self.buf[:pos]
+        return b"".join(out)
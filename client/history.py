@@ -1,15 +1,256 @@
-import os
+import os, re, sqlite3, time
+import tkinter as tk
+from channels import DEFAULT as DEFAULT_CHANNEL
+
+HISTORY_DIR = "chat_history"
+PAGE_LINES = 200
+MAX_LINES = 2000
+SEARCH_LIMIT = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    sender TEXT,
+    ts REAL,
+    kind TEXT NOT NULL,
+    target TEXT,
+    text TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    sender, text, content='messages', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, sender, text) VALUES (new.id, new.sender, new.text);
+END;
+"""
+COLUMNS = ("id", "sender", "ts", "kind", "target", "text")
+
+# Lines of the old one-file-per-user text history, as main-client wrote them.
+OLD_LINES = [
+    ("private", re.compile(r"\[Private\] you -> (?P<target>.+?): (?P<text>.*)")),
+    ("private", re.compile(r"\[Private\] (?P<sender>.+?) -> you: (?P<text>.*)")),
+    ("public", re.compile(r"(?:\[#(?P<target>[A-Za-z0-9_-]+)\] )?(?P<sender>.+?)(?: \(you\))?: (?P<text>.*)")),
+]
+
+# The chat view holds at most MAX_LINES lines. client.line_keys has one
+# entry per displayed line: the message's id in the store, or None for
+# lines that were never saved. client.history_start is the id below which
+# messages have not been shown yet (0 once everything is), and
+# client.history_end the id above which they are paged out again after
+# scrolling back (0 while the newest are shown).
+
+def history_path(username, ext="db"):
+    return os.path.join(HISTORY_DIR, f"{username}.{ext}")
+
+def open_store(username):
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    db = sqlite3.connect(history_path(username), isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    migrate(db, username)
+    return db
+
+def migrate(db, username):
+    # One-shot import of the old text history; the file is kept, renamed.
+    path = history_path(username, "txt")
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8", errors="replace") as f:
+        db.execute("BEGIN")
+        db.executemany("INSERT INTO messages (sender, kind, target, text) VALUES (?, ?, ?, ?)",
+                       (parse_old_line(line.rstrip("\n"), username) for line in f if line.strip()))
+        db.execute("COMMIT")
+    os.replace(path, path + ".migrated")
+
+def parse_old_line(line, username):
+    for kind, pattern in OLD_LINES:
+        m = pattern.fullmatch(line)
+        if m:
+            parts = m.groupdict()
+            sender = parts.get("sender") or username
+            target = parts.get("target") or (username if kind == "private" else DEFAULT_CHANNEL)
+            return sender, kind, target, parts["text"]
+    return None, "public", None, line
+
+def format_line(record, username):
+    sender, kind, target, text = (record.get(k) for k in ("sender", "kind", "target", "text"))
+    if sender is None:
+        return text
+    if kind == "private":
+        if sender == username:
+            return f"[Private] you -> {target}: {text}"
+        return f"[Private] {sender} -> you: {text}"
+    line = f"{sender} (you): {text}" if sender == username else f"{sender}: {text}"
+    return f"[#{target}] {line}" if target and target != DEFAULT_CHANNEL else line
+
+def read_page(db, before=None, n=PAGE_LINES):
+    # Up to n messages with ids below `before` (default: the newest), oldest first.
+    rows = db.execute(f"SELECT {', '.join(COLUMNS)} FROM messages WHERE id < ? ORDER BY id DESC LIMIT ?",
+                      (before or 2 ** 63 - 1, n))
+    return [dict(zip(COLUMNS, row)) for row in rows][::-1]
+
+def read_page_after(db, after, n=PAGE_LINES):
+    # Up to n messages with ids above `after`, oldest first.
+    rows = db.execute(f"SELECT {', '.join(COLUMNS)} FROM messages WHERE id > ? ORDER BY id LIMIT ?", (after, n))
+    return [dict(zip(COLUMNS, row)) for row in rows]
+
+def search(db, query, limit=SEARCH_LIMIT):
+    # Newest first. Every word of the query must appear; words are quoted so
+    # FTS syntax typed by the user is taken literally.
+    words = query.split()
+    if not words:
+        return []
+    match = " ".join('"' + w.replace('"', '""') + '"' for w in words)
+    rows = db.execute(
+        f"SELECT {', '.join('m.' + c for c in COLUMNS)} FROM messages_fts "
+        "JOIN messages m ON m.id = messages_fts.rowid "
+        "WHERE messages_fts MATCH ? ORDER BY messages_fts.rowid DESC LIMIT ?", (match, limit))
+    return [dict(zip(COLUMNS, row)) for row in rows]
 
 def load_local_history(client):
-    path = f"chat_history/{client.username}.txt"
-    if os.path.exists(path):
-        with open(path, encoding="utf-8") as f:
-            for line in f:
-                client.append_text(line.strip())
-
-def save_local_history(client, line):
-    if client.username:
-        os.makedirs("chat_history", exist_ok=True)
-        path = f"chat_history/{client.username}.txt"
-        with open(path, "a", encoding="utf-8") as f:
-            f.write(line + "\n")
+    if client.history_db is not None:
+        client.history_db.close()
+    client.history_db = open_store(client.username)
+    client.loading_page = False
+    show_newest(client)
+
+def show_newest(client):
+    # Replace the view with the newest page of the store.
+    client.line_keys.clear()
+    client.history_start = client.history_end = 0
+    ta = client.text_area
+    ta.config(state="normal")
+    ta.delete("1.0", "end")
+    ta.config(state="disabled")
+    rows = read_page(client.history_db)
+    if rows:
+        client.history_start = rows[0]["id"]
+        show_lines(client, [(r["id"], format_line(r, client.username)) for r in rows])
+
+def load_older_history(client):
+    if not client.history_start:
+        return
+    rows = read_page(client.history_db, client.history_start)
+    client.history_start = rows[0]["id"] if rows else 0
+    if not rows:
+        return
+    ta = client.text_area
+    top = int(ta.index("@0,0").split(".")[0])
+    ta.config(state="normal")
+    ta.insert("1.0", "".join(one_line(format_line(r, client.username)) + "\n" for r in rows))
+    client.line_keys.extendleft(r["id"] for r in reversed(rows))
+    # Page the same number of lines out at the bottom, to come back when
+    # scrolled down to.
+    excess = len(client.line_keys) - MAX_LINES
+    if excess > 0:
+        ta.delete(f"{MAX_LINES + 1}.0", "end")
+        for _ in range(excess):
+            key = client.line_keys.pop()
+            if key is not None:
+                client.history_end = key - 1
+    ta.config(state="disabled")
+    ta.yview(f"{top + len(rows)}.0")
+
+def load_newer_history(client):
+    if not client.history_end:
+        return
+    rows = read_page_after(client.history_db, client.history_end)
+    client.history_end = rows[-1]["id"] if len(rows) == PAGE_LINES else 0
+    if not rows:
+        return
+    ta = client.text_area
+    top = int(ta.index("@0,0").split(".")[0])
+    ta.config(state="normal")
+    ta.insert("end", "".join(one_line(format_line(r, client.username)) + "\n" for r in rows))
+    client.line_keys.extend(r["id"] for r in rows)
+    excess = len(client.line_keys) - MAX_LINES
+    if excess > 0:
+        ta.delete("1.0", f"{excess + 1}.0")
+        for _ in range(excess):
+            key = client.line_keys.popleft()
+            if key is not None:
+                client.history_start = key + 1
+    ta.config(state="disabled")
+    ta.yview(f"{max(1, top - max(excess, 0))}.0")
+
+def on_history_scroll(client, first, last):
+    if client.loading_page:
+        return
+    if float(first) <= 0.0 and client.history_start:
+        load = load_older_history
+    elif float(last) >= 1.0 and client.history_end:
+        load = load_newer_history
+    else:
+        return
+    client.loading_page = True
+    def run():
+        try:
+            load(client)
+        finally:
+            client.loading_page = False
+    client.root.after_idle(run)
+
+def show_lines(client, entries):
+    # Append (key, line) pairs with one widget update, trimming the oldest
+    # lines beyond MAX_LINES.
+    if not entries:
+        return
+    if client.history_end:
+        # Scrolled back with the newest lines paged out: jump to the newest
+        # page, which already has the saved entries, and add the rest.
+        show_newest(client)
+        entries = [(k, line) for k, line in entries if k is None]
+        if not entries:
+            return
+    ta = client.text_area
+    ta.config(state="normal")
+    ta.insert("end", "".join(one_line(line) + "\n" for _, line in entries))
+    client.line_keys.extend(k for k, _ in entries)
+    excess = len(client.line_keys) - MAX_LINES
+    if excess > 0:
+        ta.delete("1.0", f"{excess + 1}.0")
+        for _ in range(excess):
+            key = client.line_keys.popleft()
+            if key is not None:
+                client.history_start = key + 1
+    ta.config(state="disabled")
+    ta.see("end")
+
+def save_local_history(client, records):
+    # Stores the records in one transaction and returns their ids (None
+    # each if there is no store to save them in).
+    db = client.history_db
+    if db is None or not records:
+        return [None] * len(records)
+    ids = []
+    db.execute("BEGIN")
+    try:
+        for r in records:
+            ids.append(db.execute(
+                "INSERT INTO messages (sender, ts, kind, target, text) VALUES (?, ?, ?, ?, ?)",
+                (r["sender"], r.get("ts") or time.time(), r["kind"], r.get("target"), r["text"])).lastrowid)
+        db.execute("COMMIT")
+    except:
+        db.execute("ROLLBACK")
+        raise
+    return ids
+
+def search_popup(client, query):
+    if client.history_db is None or not query.strip():
+        return
+    started = time.perf_counter()
+    rows = search(client.history_db, query)
+    win = tk.Toplevel(client.root)
+    win.title(f"Search: {query}")
+    win.geometry("600x400")
+    tk.Label(win, text=f"{len(rows)} result(s) in {time.perf_counter() - started:.3f}s").pack(pady=4)
+    listbox = tk.Listbox(win)
+    listbox.pack(fill="both", expand=True, padx=6, pady=6)
+    for r in rows:
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(r["ts"])) if r["ts"] else "(imported)"
+        listbox.insert("end", f"{when}  {one_line(format_line(r, client.username))}")
+    tk.Button(win, text="Close", command=win.destroy).pack(pady=4)
+
+def one_line(line):
+    return line.replace("\r", " ").replace("\n", " ")
@@ -1,23 +1,38 @@
 import tkinter as tk
 from tkinter import messagebox
-import threading, json, os
-from ui_helpers import make_entry, append_text, show_codes_window
-from network import connect_server, send_json, disconnect_socket
+import threading, collections, queue, time
+from ui_helpers import make_entry, show_codes_window
+from network import connect_server, send_json, disconnect_socket, reconnect
 from auth import login, register, reset_password, delete_account
 from contacts import open_contacts_window, show_contacts_list, request_my_code, request_list_contacts
-from history import load_local_history, save_local_history
+from history import load_local_history, save_local_history, show_lines, on_history_scroll, format_line, search_popup
+from channels import DEFAULT as DEFAULT_CHANNEL, join_channel_popup, leave_current_channel, request_list_channels, show_channels_list
+
+PUMP_MS = 20     # how often queued server messages are handled
+PUMP_MAX = 200   # messages handled per tick at most, to keep the UI responsive
 
 class ChatClient:
     def __init__(self):
-        self.sock, self.connected, self.buffer, self.username = None, False, "", None
+        self.sock, self.connected, self.username = None, False, None
+        self.framer, self.proto = None, "json"
+        self.channels, self.channel = [DEFAULT_CHANNEL], DEFAULT_CHANNEL
+        self.session, self.reconnecting, self.resuming = None, False, False
+        self.reconnect_delay = None
+        self.last_seq, self.resume_from = 0, 0
+        self.seen = collections.deque(maxlen=1000)
+        self.history_db, self.line_keys, self.loading_page = None, collections.deque(), False
+        self.history_start, self.history_end = 0, 0
+        self.inbox, self.batch, self.pumping = queue.Queue(), [], False
         self.stop_threads = threading.Event()
         self.root = tk.Tk()
         self.root.title("Chat Client")
         self.build_connect_view()
         self.root.protocol("WM_DELETE_WINDOW", self.close_all)
+        self.root.after(PUMP_MS, self.pump)
         self.root.mainloop()
 
     def clear_root(self):
+        self.batch = []
         [c.destroy() for c in self.root.winfo_children()]
 
     def build_connect_view(self):
@@ -28,6 +43,10 @@ class ChatClient:
         self.host_entry.insert(0, "127.0.0.1")
         self.port_entry = make_entry(f, "Port")
         self.port_entry.insert(0, "5000")
+        self.binary_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(f, text="Compact binary protocol", variable=self.binary_var).pack(pady=4)
+        self.compress_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(f, text="Compress traffic", variable=self.compress_var).pack(pady=4)
         tk.Button(f, text="Connect", command=lambda: connect_server(self)).pack(pady=8)
 
     def build_auth_view(self):
@@ -47,24 +66,100 @@ class ChatClient:
         self.clear_root()
         f = tk.Frame(self.root)
         f.pack(padx=10, pady=10, fill="both", expand=True)
-        self.text_area = tk.Text(f, state="disabled", width=80, height=24)
-        self.text_area.pack(fill="both", expand=True)
+        body = tk.Frame(f)
+        body.pack(fill="both", expand=True)
+        self.text_area = tk.Text(body, state="disabled", width=80, height=24)
+        scroll = tk.Scrollbar(body, command=self.text_area.yview)
+        scroll.pack(side="right", fill="y")
+        self.text_area.pack(side="left", fill="both", expand=True)
+        self.text_area.config(yscrollcommand=lambda first, last: (
+            scroll.set(first, last), on_history_scroll(self, first, last)))
         ctrl = tk.Frame(f)
         ctrl.pack(fill="x", pady=4)
         tk.Button(ctrl, text="Contacts", command=lambda: open_contacts_window(self)).pack(side="left", padx=4)
         tk.Button(ctrl, text="Get my code", command=lambda: request_my_code(self)).pack(side="left", padx=4)
         tk.Button(ctrl, text="Refresh contacts", command=lambda: request_list_contacts(self)).pack(side="left", padx=4)
         tk.Button(ctrl, text="Private Chat", command=self.private_chat_popup).pack(side="left", padx=4)  # 新增私聊按钮
+        chan = tk.Frame(f)
+        chan.pack(fill="x", pady=4)
+        tk.Label(chan, text="Channel:").pack(side="left")
+        self.channel_var = tk.StringVar(value=self.channel)
+        self.channel_menu = tk.OptionMenu(chan, self.channel_var, *self.channels, command=self.switch_channel)
+        self.channel_menu.pack(side="left", padx=4)
+        tk.Button(chan, text="Join", command=lambda: join_channel_popup(self)).pack(side="left", padx=4)
+        tk.Button(chan, text="Leave", command=lambda: leave_current_channel(self)).pack(side="left", padx=4)
+        tk.Button(chan, text="Channels", command=lambda: request_list_channels(self)).pack(side="left", padx=4)
+        find = tk.Frame(f)
+        find.pack(fill="x", pady=4)
+        tk.Label(find, text="Search history:").pack(side="left")
+        search_entry = tk.Entry(find)
+        search_entry.pack(side="left", fill="x", expand=True, padx=4)
+        search_entry.bind("<Return>", lambda e: search_popup(self, search_entry.get()))
+        tk.Button(find, text="Search", command=lambda: search_popup(self, search_entry.get())).pack(side="left", padx=4)
         bottom = tk.Frame(f)
         bottom.pack(fill="x", pady=6)
         self.entry = tk.Entry(bottom)
         self.entry.pack(side="left", fill="x", expand=True)
         self.entry.bind("<Return>", self.send_message)
         tk.Button(bottom, text="Send", command=self.send_message).pack(side="right", padx=4)
-        os.makedirs("chat_history", exist_ok=True)
         if self.username:
             load_local_history(self)
 
+    def show(self, line, record=None):
+        # Lines shown while the pump runs are inserted, and their records
+        # saved, together once it is done.
+        self.batch.append((line, record))
+        if not self.pumping:
+            self.flush_lines()
+
+    def flush_lines(self):
+        batch, self.batch = self.batch, []
+        ids = iter(save_local_history(self, [r for _, r in batch if r]))
+        show_lines(self, [(next(ids) if r else None, line) for line, r in batch])
+
+    def pump(self):
+        # Handles queued server messages on the Tk thread, a bounded number
+        # per tick, with one widget update for all the lines they produce.
+        self.pumping = True
+        try:
+            for _ in range(PUMP_MAX):
+                try:
+                    msg = self.inbox.get_nowait()
+                except queue.Empty:
+                    break
+                self.handle_server_message(msg)
+        finally:
+            self.pumping = False
+            self.root.after(1 if not self.inbox.empty() else PUMP_MS, self.pump)
+            self.flush_lines()
+
+    def switch_channel(self, name):
+        self.channel = name
+        self.channel_var.set(name)
+        self.show(f"[System] Now talking in #{name}.")
+
+    def refresh_channel_menu(self):
+        menu = self.channel_menu["menu"]
+        menu.delete(0, "end")
+        for name in self.channels:
+            menu.add_command(label=name, command=lambda n=name: self.switch_channel(n))
+
+    def _handle_join(self, m):
+        name = m.get("channel")
+        if name in self.channels:
+            return  # rejoined after a reconnect
+        self.channels.append(name)
+        self.refresh_channel_menu()
+        self.switch_channel(name)
+
+    def _handle_leave(self, m):
+        name = m.get("channel")
+        if name in self.channels:
+            self.channels.remove(name)
+            self.refresh_channel_menu()
+        if self.channel == name:
+            self.switch_channel(DEFAULT_CHANNEL)
+
     def private_chat_popup(self):
         win = tk.Toplevel(self.root)
         win.title("Private Chat")
@@ -85,20 +180,16 @@ class ChatClient:
                 messagebox.showerror("Error", "用户名和消息都不能为空")
         tk.Button(win, text="Send", command=send).pack(pady=8)
 
-    def handle_server_message(self, line):
-        try:
-            msg = json.loads(line)
-        except:
-            return
+    def preferred_proto(self):
+        return "bin1" if self.binary_var.get() else "json"
+
+    def handle_server_message(self, msg):
         mtype = msg.get("type")
         handlers = {
             "pong": lambda m: None,
             "register_ok": lambda m: show_codes_window(self.root, m.get("recovery_codes", [])),
-            "login_ok": lambda m: (
-                setattr(self, "username", self.username_entry.get().strip()),
-                self.build_chat_view(),
-                append_text(self.text_area, "[System] Login successful.")
-            ),
+            "login_ok": lambda m: self._handle_login_ok(m),
+            "resume_ok": lambda m: self._handle_resume(m),
             "reset_ok": lambda m: messagebox.showinfo("Info", m.get("message", "OK")),
             "delete_ok": lambda m: messagebox.showinfo("Info", m.get("message", "OK")),
             "chat": lambda m: self._handle_chat(m),
@@ -107,8 +198,13 @@ class ChatClient:
             "add_contact_ok": lambda m: messagebox.showinfo("Contacts", m.get("message")),
             "remove_contact_ok": lambda m: messagebox.showinfo("Contacts", m.get("message")),
             "list_contacts_ok": lambda m: show_contacts_list(self, m.get("contacts", [])),
-            "online_status": lambda m: messagebox.showinfo("Online status", f"{m.get('user')} is {'online' if m.get('online') else 'offline'}."),
-            "error": lambda m: messagebox.showerror("Error", m.get("message", "Unknown error"))
+            "join_ok": lambda m: self._handle_join(m),
+            "leave_ok": lambda m: self._handle_leave(m),
+            "list_channels_ok": lambda m: show_channels_list(self, m),
+            "online_status": lambda m: self._handle_online_status(m),
+            "mailbox": lambda m: self._handle_mailbox(m),
+            "reconnect": lambda m: self._handle_reconnect(m),
+            "error": lambda m: self._handle_error(m)
         }
         if mtype in handlers:
             try:
@@ -120,35 +216,115 @@ class ChatClient:
                 except:
                     print("Handler Error:", e)
 
+    def _handle_login_ok(self, m):
+        # The session token replaces the password for re-login on reconnect.
+        self.session = m.get("session")
+        if self.resuming:
+            self.resuming = self.reconnecting = False
+            for name in self.channels:
+                if name != DEFAULT_CHANNEL:
+                    send_json(self, {"type": "join", "channel": name})
+            send_json(self, {"type": "resume", "last_seq": self.resume_from})
+            return self.show("[System] Reconnected.")
+        self.username = self.username_entry.get().strip()
+        self.channels, self.channel = [DEFAULT_CHANNEL], DEFAULT_CHANNEL
+        self.last_seq = m.get("last_seq") or 0
+        self.seen.clear()
+        self.build_chat_view()
+        self.show("[System] Login successful.")
+
+    def _handle_online_status(self, m):
+        # Pushed, debounced, when a contact comes online or goes offline.
+        self.show(f"[System] {m.get('user')} is {'online' if m.get('online') else 'offline'}.")
+
+    def _handle_mailbox(self, m):
+        # Private messages kept for us while we were offline, acked once shown.
+        messages = m.get("messages", [])
+        self.show(f"[System] {len(messages)} message(s) arrived while you were offline.")
+        for msg in messages:
+            self._handle_private_chat(msg)
+        send_json(self, {"type": "mailbox_ack", "seq": m.get("last_seq")})
+
+    def _handle_reconnect(self, m):
+        # The server is restarting; read_loop noted its delay for reconnect().
+        self.show(f"[System] Server restarting, reconnecting in {m.get('delay')}s...")
+
+    def _handle_error(self, m):
+        if self.resuming:
+            # re-login after a reconnect failed; fall back to the login form
+            self.resuming, self.username, self.session = False, None, None
+            self.build_auth_view()
+        messagebox.showerror("Error", m.get("message", "Unknown error"))
+
+    def _handle_resume(self, m):
+        for msg in m.get("messages", []):
+            self.handle_server_message(msg)
+        if m.get("more"):
+            send_json(self, {"type": "resume", "last_seq": m.get("last_seq", self.last_seq)})
+
+    def _is_new(self, m):
+        # Drops messages already shown, e.g. delivered live and again by resume.
+        seq = m.get("seq")
+        if seq is None:
+            return True
+        if seq in self.seen:
+            return False
+        self.seen.append(seq)
+        self.last_seq = max(self.last_seq, seq)
+        return True
+
     def _handle_chat(self, m):
-        u, text = m.get("from", "Unknown"), m.get("message", "")
-        line = f"{u} (you): {text}" if u == self.username else f"{u}: {text}"
-        append_text(self.text_area, line)
-        save_local_history(self, line)
+        if not self._is_new(m):
+            return
+        r = {"sender": m.get("from", "Unknown"), "ts": m.get("ts") or time.time(), "kind": "public",
+             "target": m.get("channel", DEFAULT_CHANNEL), "text": m.get("message", "")}
+        self.show(format_line(r, self.username), r)
 
     def _handle_private_chat(self, m):
-        if "from" in m:
-            line = f"[Private] {m['from']} -> you: {m['message']}"
-        else:
-            line = f"[Private] you -> {m['to']}: {m['message']}"
-        append_text(self.text_area, line)
-        save_local_history(self, line)
+        if not self._is_new(m):
+            return
+        sender, target = (m["from"], self.username) if "from" in m else (self.username, m["to"])
+        r = {"sender": sender, "ts": m.get("ts") or time.time(), "kind": "private", "target": target, "text": m["message"]}
+        self.show(format_line(r, self.username), r)
 
     def send_message(self, event=None):
         text = self.entry.get().strip()
         self.entry.delete(0, tk.END)
         if text:
-            send_json(self, {"type": "chat", "message": text})
+            send_json(self, {"type": "chat", "channel": self.channel, "message": text})
 
-    def on_disconnect(self):
+    def on_disconnect(self, sock=None):
+        if sock is not None and sock is not self.sock:
+            return  # a socket we already replaced
         disconnect_socket(self)
         self.stop_threads.set()
+        if self.reconnecting:
+            return
+        if self.username and self.session:
+            self.reconnecting = True
+            self.resume_from = self.last_seq
+            self.show("[System] Connection lost, reconnecting...")
+            threading.Thread(target=reconnect, args=(self,), daemon=True).start()
+            return
+        messagebox.showwarning("Disconnected", "Lost connection to server.")
+        self.build_connect_view()
+
+    def on_reconnected(self):
+        self.resuming = True
+        send_json(self, {"type": "resume_session", "token": self.session})
+
+    def on_reconnect_failed(self):
+        self.reconnecting = False
+        self.username = None
         messagebox.showwarning("Disconnected", "Lost connection to server.")
         self.build_connect_view()
 
     def close_all(self):
+        self.reconnecting = False
         self.stop_threads.set()
         disconnect_socket(self)
+        if self.history_db is not None:
+            self.history_db.close()
         self.root.destroy()
 
 if __name__ == "__main__":
@@ -1,58 +1,136 @@
 
-import socket, threading, json, time
+import socket, threading, time, random
 from tkinter import messagebox
+from framing import Framer, encode, JSON_LINES, Deflater, Inflater
+
+HANDSHAKE_TIMEOUT = 5
+RECONNECT_TRIES = 10
+BACKOFF_BASE = 1     # seconds; the n-th retry waits up to BACKOFF_BASE * 2**n
+BACKOFF_MAX = 60
+HEARTBEAT = 2  # ping interval for servers that do not advertise one
 
 def connect_server(client):
     try:
         port = int(client.port_entry.get().strip())
     except:
         return messagebox.showerror("Error", "Port must be a number.")
-    disconnect_socket(client)
-    client.stop_threads.clear()
+    host = client.host_entry.get().strip()
+    client.wanted_proto = client.preferred_proto()
+    client.wanted_compress = client.compress_var.get()
     try:
-        client.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.sock.connect((client.host_entry.get().strip(), port))
-        client.sock.settimeout(None)
-        client.connected = True
-        print(f"已连接到服务器：{client.host_entry.get().strip()}:{port}")  # 新增日志
+        open_connection(client, host, port)
+        print(f"已连接到服务器：{host}:{port}")  # 新增日志
         messagebox.showinfo("Info", "Connected to server")
     except Exception as e:
-        client.connected = False
-        client.sock = None
         print(f"连接失败：{e}")  # 新增日志
         return messagebox.showerror("Error", f"Connection failed: {e}")
     client.build_auth_view()
-    threading.Thread(target=read_loop, args=(client,), daemon=True).start()
+
+def open_connection(client, host, port):
+    # Connect, negotiate the protocol and start the reader and pinger for
+    # this socket. Raises if the server cannot be reached.
+    disconnect_socket(client)
+    client.stop_threads.clear()
+    sock = socket.create_connection((host, port), timeout=HANDSHAKE_TIMEOUT)
+    framer = Framer()
+    try:
+        proto, heartbeat, compress = handshake(sock, framer, client.wanted_proto, client.wanted_compress)
+    except:
+        sock.close()
+        raise
+    sock.settimeout(None)
+    client.sock, client.framer, client.proto = sock, framer, proto
+    client.send_lock = threading.Lock()
+    client.deflater = Deflater() if compress else None
+    inflater = Inflater() if compress else None
+    if inflater:
+        framer.feed(inflater.feed(framer.take_rest()))
+    client.heartbeat, client.last_sent = heartbeat, time.monotonic()
+    client.server = (host, port)
+    client.connected = True
+    threading.Thread(target=read_loop, args=(client, sock, framer, inflater), daemon=True).start()
     threading.Thread(target=ping_loop, args=(client,), daemon=True).start()
 
+def handshake(sock, framer, want, compress=False):
+    # Offer the preferred protocol (and compression) and wait for the answer
+    # before anything else is sent. Servers without "hello" answer with an
+    # error and we stay on uncompressed JSON lines. Returns the protocol, the
+    # heartbeat interval and whether the stream is compressed from now on.
+    hello = {"type": "hello", "proto": want}
+    if compress:
+        hello["compress"] = "zlib"
+    sock.sendall(encode(hello))
+    reply = None
+    while reply is None:
+        data = sock.recv(4096)
+        if not data: raise ConnectionError("Connection closed during handshake")
+        framer.feed(data)
+        reply = framer.next()
+    if reply.get("type") != "hello_ok":
+        return JSON_LINES, HEARTBEAT, False
+    framer.proto = reply.get("proto", JSON_LINES)
+    return framer.proto, reply.get("heartbeat", HEARTBEAT), reply.get("compress") == "zlib"
+
+def backoff(attempt):
+    # Exponential backoff with full jitter, so clients that lost the server
+    # together spread their retries out instead of arriving in waves.
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def reconnect(client):
+    # Runs in the background after a dropped connection; the client logs in
+    # again and resumes from its last seen seq once this succeeds. The first
+    # wait is the one the server suggested when it announced a restart.
+    host, port = client.server
+    delay, client.reconnect_delay = client.reconnect_delay, None
+    for attempt in range(RECONNECT_TRIES):
+        time.sleep(delay if delay is not None else backoff(attempt))
+        delay = None
+        if not client.reconnecting: return
+        try:
+            open_connection(client, host, port)
+        except Exception as e:
+            print(f"重连失败：{e}")
+            continue
+        return client.root.after(0, client.on_reconnected)
+    client.root.after(0, client.on_reconnect_failed)
+
 def send_json(client, obj):
-    if not client.connected or not client.sock: return
+    sock = client.sock
+    if not client.connected or not sock: return
     try:
-        data = (json.dumps(obj) + "\n").encode("utf-8")
-        client.sock.sendall(data)
+        data = encode(obj, client.proto)
+        # one sender at a time: the deflate context is a single stream
+        with client.send_lock:
+            sock.sendall(client.deflater.pack(data) if client.deflater else data)
+        client.last_sent = time.monotonic()
     except:
-        client.root.after(0, client.on_disconnect)
+        client.root.after(0, client.on_disconnect, sock)
 
-def read_loop(client):
+def read_loop(client, sock, framer, inflater=None):
     try:
-        while client.connected and not client.stop_threads.is_set():
-            data = client.sock.recv(4096)
+        while not client.stop_threads.is_set():
+            data = sock.recv(4096)
             if not data: break
-            client.buffer += data.decode("utf-8", errors="ignore")
-            while "\n" in client.buffer:
-                line, client.buffer = client.buffer.split("\n", 1)
-                if line.strip():
-                    client.root.after(0, client.handle_server_message, line)
+            framer.feed(inflater.feed(data) if inflater else data)
+            for msg in framer.messages():
+                if msg.get("type") == "reconnect":
+                    # recorded here, as the disconnect may beat the pump to it
+                    client.reconnect_delay = msg.get("delay")
+                client.inbox.put(msg)
     except:
         pass
-    client.root.after(0, client.on_disconnect)
+    client.root.after(0, client.on_disconnect, sock)
 
 def ping_loop(client):
-    while client.connected and not client.stop_threads.is_set():
-        send_json(client, {"type": "ping"})
-        for _ in range(20):
-            if client.stop_threads.is_set(): return
-            time.sleep(0.1)
+    # Anything sent keeps the connection alive, so only ping after a full
+    # heartbeat interval with nothing else sent.
+    while client.connected:
+        idle = time.monotonic() - client.last_sent
+        if idle >= client.heartbeat:
+            send_json(client, {"type": "ping"})
+            idle = 0
+        if client.stop_threads.wait(client.heartbeat - idle):
+            return
 
 def disconnect_socket(client):
     try:
@@ -0,0 +1,59 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+POOL_SIZE = 4
+QUEUE_LIMIT = 256
+
+class AuthPool:
+    # Fixed-size executor for password hashing and account writes. submit()
+    # refuses work once POOL_SIZE + QUEUE_LIMIT jobs are in flight so a login
+    # burst is shed at the door instead of piling up behind the workers.
+    def __init__(self, workers=None, queue_limit=None):
+        self.workers = workers or POOL_SIZE
+        self.limit = self.workers + (QUEUE_LIMIT if queue_limit is None else queue_limit)
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="auth")
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.inflight = self.running = 0
+        self.submitted = self.rejected = self.completed = 0
+        self.busy = 0.0
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.inflight >= self.limit:
+                self.rejected += 1
+                return False
+            self.inflight += 1
+            self.submitted += 1
+        self.executor.submit(self._run, fn, args)
+        return True
+
+    def _run(self, fn, args):
+        with self.lock:
+            self.running += 1
+        t0 = time.monotonic()
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"认证任务异常：{e}")
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.inflight -= 1
+                self.completed += 1
+                self.busy += time.monotonic() - t0
+
+    def stats(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            return {
+                "workers": self.workers,
+                "running": self.running,
+                "queued": self.inflight - self.running,
+                "queue_limit": self.limit - self.workers,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "utilization": round(self.busy / (self.workers * elapsed), 4),
+            }
@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import sys
+import time
+
+from framing import Framer, encode, JSON_LINES, PROTOCOLS, Deflater, Inflater
+
+PASSWORD = "bench-password"
+MIX = "chat=30,private_chat=30,list_contacts=10,ping=30"
+OPS = ("chat", "private_chat", "list_contacts", "ping")
+REPLIES = {"register": "register_ok", "login": "login_ok", "join": "join_ok",
+           "list_contacts": "list_contacts_ok", "ping": "pong"}
+# Chat text sent by the benchmark carries an id and the send time, so every
+# receiver can measure delivery latency without a clock shared with the server.
+TAG = "bench"
+TIMEOUT = 10
+
+now = time.perf_counter
+
+class Stats:
+    def __init__(self):
+        self.latency = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def record(self, name, seconds):
+        self.latency[name].append(seconds)
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+class User:
+    # One simulated client. Runs at most one operation at a time and waits
+    # for its reply, its own echo, or an error before the next.
+    def __init__(self, name, stats):
+        self.name = name
+        self.stats = stats
+        self.framer = Framer()
+        self.proto = JSON_LINES
+        self.deflater = self.inflater = None
+        self.waiting = None  # (reply type, bench id or None, future)
+
+    async def connect(self, host, port, proto, compress=False):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        hello = {"type": "hello", "proto": proto}
+        if compress:
+            hello["compress"] = "zlib"
+        self.writer.write(encode(hello))
+        reply = None
+        while reply is None:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("closed during handshake")
+            self.framer.feed(data)
+            reply = self.framer.next()
+        if reply.get("type") == "hello_ok":
+            self.proto = self.framer.proto = reply.get("proto", JSON_LINES)
+            if reply.get("compress") == "zlib":
+                self.deflater, self.inflater = Deflater(), Inflater()
+                self.framer.feed(self.inflater.feed(self.framer.take_rest()))
+        self.task = asyncio.create_task(self.read())
+
+    async def read(self):
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                self.framer.feed(self.inflater.feed(data) if self.inflater else data)
+                for msg in self.framer.messages():
+                    self.dispatch(msg)
+        except (ConnectionError, OSError):
+            pass
+        self.stats.errors["disconnected"] += 1
+        if self.waiting:
+            self.waiting[2].cancel()
+
+    def dispatch(self, msg):
+        mtype = msg.get("type")
+        text = msg.get("message", "")
+        if mtype in ("chat", "private_chat") and text.startswith(TAG + " "):
+            _, bench_id, sent = text.split(" ", 2)
+            if msg.get("from", self.name) != self.name:
+                name = "chat fan-out" if mtype == "chat" else "private delivery"
+                self.stats.record(name, now() - float(sent))
+            else:
+                self.resolve(mtype, bench_id, msg)
+        elif mtype == "error":
+            self.resolve(None, None, msg)
+        else:
+            self.resolve(mtype, None, msg)
+
+    def resolve(self, mtype, bench_id, msg):
+        if self.waiting is None:
+            return
+        want, want_id, fut = self.waiting
+        if (mtype is None or (mtype == want and bench_id == want_id)) and not fut.done():
+            fut.set_result(msg)
+
+    async def call(self, op, obj, reply=None, bench_id=None):
+        # Sends obj and returns the reply; latency is recorded under op.
+        fut = asyncio.get_running_loop().create_future()
+        self.waiting = (reply or REPLIES[op], bench_id, fut)
+        started = now()
+        data = encode(obj, self.proto)
+        self.writer.write(self.deflater.pack(data) if self.deflater else data)
+        try:
+            msg = await asyncio.wait_for(fut, TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self.stats.errors[f"{op}: timeout"] += 1
+            return None
+        finally:
+            self.waiting = None
+        if msg.get("type") == "error":
+            self.stats.errors[f"{op}: {msg.get('message')}"] += 1
+            return msg
+        self.stats.record(op, now() - started)
+        return msg
+
+    async def setup(self, channel):
+        # Registers (already registered is fine, busy is retried) and logs in.
+        while True:
+            r = await self.call("register", {"type": "register", "username": self.name, "password": PASSWORD})
+            if r and r.get("message") == "Server busy, please retry.":
+                await asyncio.sleep(random.uniform(0.05, 0.2))
+                continue
+            break
+        while True:
+            r = await self.call("login", {"type": "login", "username": self.name, "password": PASSWORD})
+            if r and r.get("type") == "error" and r.get("message") == "Server busy, please retry.":
+                await asyncio.sleep(random.uniform(0.05, 0.2))
+                continue
+            break
+        if r is None or r.get("type") != "login_ok":
+            raise RuntimeError(f"{self.name} could not log in: {r}")
+        if channel:
+            await self.call("join", {"type": "join", "channel": channel})
+
+    async def run(self, op, users, channel, seq):
+        bench_id = f"{os.getpid()}-{seq}"
+        text = f"{TAG} {bench_id} {now():.6f}"
+        if op == "chat":
+            await self.call(op, {"type": "chat", "channel": channel, "message": text}, "chat", bench_id)
+        elif op == "private_chat":
+            to = random.choice(users)
+            while to is self and len(users) > 1:
+                to = random.choice(users)
+            await self.call(op, {"type": "private_chat", "to": to.name, "message": text}, "private_chat", bench_id)
+        else:
+            await self.call(op, {"type": op})
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        op, _, weight = part.partition("=")
+        if op.strip() not in OPS:
+            raise ValueError(f"unknown operation {op!r}, expected one of {', '.join(OPS)}")
+        mix[op.strip()] = float(weight or 1)
+    return mix
+
+async def bench(args):
+    stats = Stats()
+    users = [User(f"{args.prefix}{i}", stats) for i in range(args.users)]
+    ramp = asyncio.Semaphore(args.ramp)
+
+    async def start(u):
+        async with ramp:
+            await u.connect(args.host, args.port, args.proto, args.compress)
+            await u.setup(args.channel if args.channel != "global" else None)
+
+    started = now()
+    await asyncio.gather(*(start(u) for u in users))
+    print(f"{len(users)} users connected and logged in in {now() - started:.1f}s", file=sys.stderr)
+
+    mix = parse_mix(args.mix)
+    ops, weights = list(mix), list(mix.values())
+    idle = list(users)
+    tasks = set()
+    skipped = 0
+
+    async def one(u, op, seq):
+        try:
+            await u.run(op, users, args.channel, seq)
+        finally:
+            idle.append(u)
+
+    # Open loop: operations are issued at the target rate whatever the
+    # latency; when every user is busy the operation is skipped and counted.
+    interval = 1 / args.rate
+    load_start = now()
+    deadline = load_start + args.duration
+    seq = 0
+    while now() < deadline:
+        seq += 1
+        if idle:
+            i = random.randrange(len(idle))
+            idle[i], idle[-1] = idle[-1], idle[i]
+            u = idle.pop()
+            t = asyncio.create_task(one(u, random.choices(ops, weights)[0], seq))
+            tasks.add(t)
+            t.add_done_callback(tasks.discard)
+        else:
+            skipped += 1
+        await asyncio.sleep(max(0, load_start + seq * interval - now()))
+    elapsed = now() - load_start
+    if tasks:
+        await asyncio.wait(tasks, timeout=TIMEOUT)
+    await asyncio.sleep(args.drain)
+    for u in users:
+        u.close()
+    return stats, elapsed, skipped
+
+def report(stats, elapsed, skipped, as_json=False):
+    rows = {}
+    for name in list(REPLIES) + list(OPS) + ["chat fan-out", "private delivery"]:
+        values = sorted(stats.latency.get(name, ()))
+        if not values:
+            continue
+        rows[name] = {
+            "count": len(values),
+            "per_sec": round(len(values) / elapsed, 1) if name not in ("register", "login", "join") else None,
+            "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            "p999_ms": round(percentile(values, 0.999) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3),
+        }
+    if as_json:
+        return print(json.dumps({"elapsed": round(elapsed, 3), "skipped": skipped,
+                                 "latency": rows, "errors": dict(stats.errors)}, indent=2))
+    print(f"\n{'operation':<18}{'count':>9}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}{'max ms':>10}")
+    for name, r in rows.items():
+        rate = "" if r["per_sec"] is None else r["per_sec"]
+        print(f"{name:<18}{r['count']:>9}{rate:>10}{r['p50_ms']:>10}{r['p99_ms']:>10}{r['p999_ms']:>10}{r['max_ms']:>10}")
+    print(f"\nload phase {elapsed:.1f}s, {skipped} operations skipped with every user busy")
+    for err, n in stats.errors.most_common():
+        print(f"error x{n}: {err}")
+
+def main():
+    p = argparse.ArgumentParser(description="Load the chat server with simulated users and report latency")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=5000)
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--rate", type=float, default=200, help="operations per second across all users")
+    p.add_argument("--duration", type=float, default=10, help="seconds of load after everyone is logged in")
+    p.add_argument("--mix", default=MIX, help=f"operation weights, e.g. {MIX}")
+    p.add_argument("--channel", default="global",
+                   help="channel the users chat in; any other than global is joined first, keeping fan-out to bench users")
+    p.add_argument("--proto", choices=PROTOCOLS, default=JSON_LINES)
+    p.add_argument("--compress", action="store_true", help="ask for zlib stream compression")
+    p.add_argument("--prefix", default="bench", help="simulated usernames are <prefix><n>")
+    p.add_argument("--ramp", type=int, default=50, help="users connecting and logging in at once")
+    p.add_argument("--drain", type=float, default=1, help="seconds to wait for deliveries after the load")
+    p.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = p.parse_args()
+    report(*asyncio.run(bench(args)), as_json=args.json)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import os
+import socket
+import threading
+
+from connection import Connection
+from framing import Frame, Framer
+
+BUS_PATH = "chat-bus.sock"
+BUS_QUEUE = 65536
+# Events that are chat traffic: logged (which stamps a seq) and delivered
+# by every worker. Anything else, like presence, goes to the other workers.
+# Private messages to a user who is offline at that point in the sequence
+# are flagged, and the log writer puts them in the user's mailbox.
+LOGGED = ("chat", "private")
+
+def _record(event):
+    return {k: v for k, v in event.items() if k not in ("op", "seq")}
+
+def _link(sock):
+    # Bus links must not lose events, so they spill instead of dropping.
+    return Connection(sock, maxlen=BUS_QUEUE, policy="spill")
+
+def _read(conn, handle):
+    framer = Framer()
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            return
+        framer.feed(data)
+        for event in framer.messages():
+            handle(event)
+
+class LocalBus:
+    # Single-process server: log and deliver in the caller's thread. The lock
+    # keeps delivery in seq order, as the hub does for workers. Events meant
+    # only for other workers, like presence, have nobody to go to.
+    def __init__(self, chat_log, deliver, online):
+        self.chat_log = chat_log
+        self.deliver = deliver
+        self.online = online
+        self.lock = threading.Lock()
+
+    def publish(self, event):
+        if event["op"] not in LOGGED:
+            return
+        with self.lock:
+            if event["op"] == "private" and not self.online(event["to"]):
+                event["offline"] = True
+            event["seq"] = self.chat_log.append(_record(event))
+            self.deliver(event)
+
+    def sync(self, fn):
+        # Call fn once everything published so far, including an event being
+        # published right now, is written out.
+        with self.lock:
+            self.chat_log.after(fn)
+
+def listen(path=None):
+    path = path or BUS_PATH
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen()
+    return sock
+
+class Hub:
+    # Runs in the parent of a multi-worker server. Owns the chat log so
+    # records get one global sequence, relays chat traffic to every worker
+    # and presence changes to the others, and remembers who is online where
+    # so late or restarted workers get a snapshot.
+    def __init__(self, sock, chat_log):
+        self.sock = sock
+        self.chat_log = chat_log
+        self.lock = threading.Lock()
+        self.workers = {}
+
+    def start(self):
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            sock, _ = self.sock.accept()
+            conn = _link(sock)
+            with self.lock:
+                for users in self.workers.values():
+                    for u in users:
+                        conn.send(Frame({"op": "presence", "user": u, "online": True}))
+                self.workers[conn] = set()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            _read(conn, lambda event: self.route(conn, event))
+        except OSError:
+            pass
+        finally:
+            conn.close()
+            with self.lock:
+                users = self.workers.pop(conn, set())
+            for u in users:
+                self.route(None, {"op": "presence", "user": u, "online": False})
+
+    def route(self, origin, event):
+        with self.lock:
+            if event.get("op") == "sync":
+                # answered to the origin alone, once the log has caught up
+                return self.chat_log.after(lambda: origin.send(Frame(event)))
+            if event.get("op") in LOGGED:
+                if event["op"] == "private" and not any(event["to"] in users for users in self.workers.values()):
+                    event["offline"] = True
+                event["seq"] = self.chat_log.append(_record(event))
+                targets = list(self.workers)
+            else:
+                if event.get("op") == "presence" and origin in self.workers:
+                    users = self.workers[origin]
+                    (users.add if event["online"] else users.discard)(event["user"])
+                targets = [c for c in self.workers if c is not origin]
+            frame = Frame(event)
+            for c in targets:
+                c.send(frame)
+
+class RemoteBus:
+    # Worker side of the hub link. Chat events come back from the hub
+    # stamped with their seq and are delivered from the link's reader thread.
+    def __init__(self, path, deliver):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path or BUS_PATH)
+        self.conn = _link(sock)
+        self.deliver = deliver
+        self.lock = threading.Lock()
+        self.syncs = {}
+        self.sync_id = 0
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def _reader(self):
+        try:
+            _read(self.conn, self._handle)
+        except OSError:
+            pass
+        print("消息总线已断开，工作进程退出")
+        os._exit(1)
+
+    def _handle(self, event):
+        if event.get("op") != "sync":
+            return self.deliver(event)
+        with self.lock:
+            fn = self.syncs.pop(event["id"], None)
+        try:
+            fn and fn()
+        except Exception as e:
+            print(f"同步回调失败：{e}")
+
+    def publish(self, event):
+        self.conn.send(Frame(event))
+
+    def sync(self, fn):
+        # The hub handles this worker's events in order, so once it has
+        # logged everything up to the sync it has everything published before.
+        with self.lock:
+            self.sync_id += 1
+            self.syncs[self.sync_id] = fn
+            event = {"op": "sync", "id": self.sync_id}
+        self.conn.send(Frame(event))
@@ -0,0 +1,35 @@
+import re
+import threading
+
+DEFAULT = "global"
+NAME = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
+def valid_name(name):
+    return bool(NAME.match(name or ""))
+
+class Channels:
+    # channel name -> set of subscribed connections on this server.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subs = {}
+
+    def join(self, name, conn):
+        with self.lock:
+            self.subs.setdefault(name, set()).add(conn)
+
+    def leave(self, name, conn):
+        with self.lock:
+            conns = self.subs.get(name)
+            if conns is None:
+                return
+            conns.discard(conn)
+            if not conns:
+                del self.subs[name]
+
+    def members(self, name):
+        with self.lock:
+            return list(self.subs.get(name, ()))
+
+    def counts(self):
+        with self.lock:
+            return {name: len(conns) for name, conns in self.subs.items()}
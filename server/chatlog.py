@@ -0,0 +1,192 @@
+import json
+import os
+import re
+import struct
+import threading
+import time
+
+FLUSH_INTERVAL = 0.05
+# Pause before writing a batch again after a failed commit.
+RETRY_DELAY = 1.0
+FSYNC = "never"
+FSYNC_POLICIES = ("never", "batch", "second")
+
+# chat.idx holds one fixed-size entry per record: seq, ts, offset, length.
+IDX = struct.Struct("<QdQI")
+# users/<name>.idx holds the seqs of private records a user sent or received
+# and channels/<name>.idx the seqs of each channel's records; a user's view
+# is the records of their channels plus their private ones.
+SEQ = struct.Struct("<Q")
+SAFE_NAME = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def file_name(name):
+    # Names usable as a file name as they are keep it, so existing logs stay
+    # readable; anything else (slashes, dots, ..) is hex-encoded behind "~".
+    return name if SAFE_NAME.match(name) else "~" + name.encode().hex()
+
+class ChatLog:
+    # Single append-only log written by one background thread. Records are
+    # queued by append() and written in group commits every flush_interval.
+    # Private records flagged offline also go to the recipient's mailbox.
+    def __init__(self, path, flush_interval=None, fsync=None, mailbox=None):
+        self.path = path
+        self.mailbox = mailbox
+        self.flush_interval = FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.fsync = fsync or FSYNC
+        os.makedirs(os.path.join(path, "users"), exist_ok=True)
+        os.makedirs(os.path.join(path, "channels"), exist_ok=True)
+        self.log = open(os.path.join(path, "chat.log"), "a+b")
+        self.idx = open(os.path.join(path, "chat.idx"), "a+b")
+        self.next_seq, self.size = self._recover()
+        self.idx_size = (self.next_seq - 1) * IDX.size
+        self.lock = threading.Condition()
+        self.pending = []
+        self.waiters = []   # (seq, fn) to call once seq is committed
+        self.committed = self.next_seq - 1
+        self.last_sync = time.monotonic()
+        self.closed = False
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _recover(self):
+        # Drop a torn idx entry and any log bytes that never got indexed.
+        n = os.path.getsize(self.idx.name) // IDX.size
+        self.idx.truncate(n * IDX.size)
+        if not n:
+            self.log.truncate(0)
+            return 1, 0
+        self.idx.seek((n - 1) * IDX.size)
+        seq, _, offset, length = IDX.unpack(self.idx.read(IDX.size))
+        self.log.truncate(offset + length)
+        return seq + 1, offset + length
+
+    def append(self, record):
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.pending.append(dict(record, seq=seq, ts=round(time.time(), 3)))
+            if len(self.pending) == 1:
+                self.lock.notify()
+        return seq
+
+    def lag(self):
+        with self.lock:
+            if not self.pending:
+                return 0, 0.0
+            return len(self.pending), time.time() - self.pending[0]["ts"]
+
+    def flush(self, timeout=5):
+        with self.lock:
+            target = self.next_seq - 1
+            self.lock.wait_for(lambda: self.committed >= target, timeout)
+
+    def after(self, fn):
+        # Call fn from the writer once everything appended so far is written,
+        # or right away if it already is.
+        with self.lock:
+            if self.committed < self.next_seq - 1:
+                self.waiters.append((self.next_seq - 1, fn))
+                return
+        fn()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: self.pending or self.closed)
+                if self.closed and not self.pending:
+                    break
+            time.sleep(self.flush_interval)
+            with self.lock:
+                batch, self.pending = self.pending, []
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # Nothing of the batch was kept. Records are found by seq, so
+                # it is written again, before anything newer, until it sticks.
+                print(f"聊天记录写入失败，{len(batch)} 条记录稍后重试：{e}")
+                with self.lock:
+                    self.pending[:0] = batch
+                time.sleep(RETRY_DELAY)
+                continue
+            with self.lock:
+                self.committed = batch[-1]["seq"]
+                self.lock.notify_all()
+                due = [fn for seq, fn in self.waiters if seq <= self.committed]
+                self.waiters = [w for w in self.waiters if w[0] > self.committed]
+            for fn in due:
+                try:
+                    fn()
+                except Exception as e:
+                    print(f"提交回调失败：{e}")
+        self.log.close()
+        self.idx.close()
+
+    def _commit(self, batch):
+        lines, entries, private, public, boxes = [], [], {}, {}, {}
+        offset = self.size
+        for r in batch:
+            line = json.dumps(r, ensure_ascii=False).encode() + b"\n"
+            lines.append(line)
+            entries.append(IDX.pack(r["seq"], r["ts"], offset, len(line)))
+            offset += len(line)
+            if "to" in r:
+                for u in {r["from"], r["to"]}:
+                    private.setdefault(self._user_idx(u), []).append(SEQ.pack(r["seq"]))
+                if r.get("offline"):
+                    boxes.setdefault(r["to"], []).append(line)
+            else:
+                public.setdefault(self._channel_idx(r.get("channel", "global")), []).append(SEQ.pack(r["seq"]))
+        try:
+            self.log.write(b"".join(lines))
+            self.log.flush()
+            self.idx.write(b"".join(entries))
+            self.idx.flush()
+        except Exception:
+            self._reopen()
+            raise
+        self.size = offset
+        self.idx_size += len(entries) * IDX.size
+        for path, seqs in list(private.items()) + list(public.items()):
+            try:
+                with open(path, "ab") as f:
+                    f.write(b"".join(seqs))
+            except OSError as e:
+                print(f"索引写入失败：{path}，原因：{e}")
+        for username, box in boxes.items() if self.mailbox else ():
+            try:
+                self.mailbox.append(username, box)
+            except OSError as e:
+                print(f"离线消息写入失败：{username} 的 {len(box)} 条消息未能存入信箱，原因：{e}")
+        now = time.monotonic()
+        if self.fsync == "batch" or (self.fsync == "second" and now - self.last_sync >= 1):
+            try:
+                os.fsync(self.log.fileno())
+                os.fsync(self.idx.fileno())
+            except OSError as e:
+                print(f"聊天记录同步失败：{e}")
+            self.last_sync = now
+
+    def _reopen(self):
+        # Throw away whatever part of a failed batch reached the files, or
+        # is still in their buffers, so the next write lands where the index
+        # says it does.
+        for f in (self.log, self.idx):
+            try:
+                f.close()
+            except (OSError, ValueError):
+                pass
+        self.log = open(os.path.join(self.path, "chat.log"), "a+b")
+        self.idx = open(os.path.join(self.path, "chat.idx"), "a+b")
+        self.log.truncate(self.size)
+        self.idx.truncate(self.idx_size)
+
+    def _user_idx(self, username):
+        return os.path.join(self.path, "users", f"{file_name(username)}.idx")
+
+    def _channel_idx(self, channel):
+        return os.path.join(self.path, "channels", f"{file_name(channel)}.idx")
@@ -0,0 +1,290 @@
+import asyncio
+import collections
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+from framing import Framer, JSON_LINES
+
+QUEUE_SIZE = 1024
+SPILL_LIMIT = 64 * 1024 * 1024
+POLICY = "drop_oldest"
+POLICIES = ("drop_oldest", "disconnect", "spill")
+# A writer waits up to COALESCE_WINDOW seconds for more frames and then
+# writes everything queued, up to COALESCE_BYTES, with a single call.
+COALESCE_WINDOW = 0.002
+COALESCE_BYTES = 64 * 1024
+# Longest inbound frame a client may send; longer ones drop the connection.
+MAX_FRAME = 64 * 1024
+
+_LEN = struct.Struct("!I")
+_totals_lock = threading.Lock()
+totals = collections.Counter()
+
+def _count(key, n=1):
+    with _totals_lock:
+        totals[key] += n
+
+def _wrote(frames, nbytes, raw):
+    with _totals_lock:
+        totals["writes"] += 1
+        totals["frames_written"] += frames
+        totals["bytes_out"] += nbytes
+        totals["bytes_out_uncompressed"] += raw
+
+class Outbound:
+    # Bounded per-connection frame queue. send() never blocks and never raises;
+    # a writer owned by the subclass drains it in order. The connection also
+    # carries its negotiated wire protocol, compression and inbound framer.
+    def __init__(self, maxlen=None, policy=None):
+        self.lock = threading.Lock()
+        self.proto = JSON_LINES
+        self.framer = Framer(max_size=MAX_FRAME)
+        self.inflater = None
+        self.deflater = None
+        self.plain = 0  # queued frames from before compression was switched on
+        self.queue = collections.deque()
+        self.maxlen = maxlen or QUEUE_SIZE
+        self.policy = policy or POLICY
+        self.closed = False
+        self.dropped = 0
+        self.high_water = 0
+        self.spill = None
+        self.spill_read = self.spill_write = 0
+        self.spilled = 0
+
+    @property
+    def depth(self):
+        return len(self.queue) + self.spilled
+
+    def send(self, frame, switch_to=None, deflater=None):
+        # frame is a framing.Frame, encoded here for this connection's protocol.
+        # switch_to changes the outbound protocol right after this frame and
+        # deflater starts compressing what is written after it.
+        overflow = False
+        with self.lock:
+            if self.closed:
+                return
+            frame = frame.encode(self.proto)
+            if switch_to:
+                self.proto = switch_to
+            if self.spilled or len(self.queue) >= self.maxlen:
+                if self.policy == "disconnect":
+                    overflow = True
+                elif self.policy == "spill" and self.spill_write + len(frame) < SPILL_LIMIT:
+                    self._spill(frame)
+                elif self.policy == "spill":
+                    overflow = True
+                else:
+                    self.queue.popleft()
+                    self.queue.append(frame)
+                    self.plain = max(0, self.plain - 1)
+                    self.dropped += 1
+                    _count("dropped")
+            else:
+                self.queue.append(frame)
+            if deflater:
+                self.deflater, self.plain = deflater, self.depth
+            self.high_water = max(self.high_water, self.depth)
+        if overflow:
+            _count("slow_disconnects")
+            self.abort()
+        else:
+            self._wake()
+
+    def _spill(self, frame):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile()
+        self.spill.seek(self.spill_write)
+        self.spill.write(_LEN.pack(len(frame)) + frame)
+        self.spill_write = self.spill.tell()
+        self.spilled += 1
+        _count("spilled")
+
+    def _unspill(self):
+        self.spill.seek(self.spill_read)
+        n, = _LEN.unpack(self.spill.read(_LEN.size))
+        frame = self.spill.read(n)
+        self.spill_read = self.spill.tell()
+        self.spilled -= 1
+        if not self.spilled:
+            self.spill.seek(0)
+            self.spill.truncate()
+            self.spill_read = self.spill_write = 0
+        return frame
+
+    def _batch(self):
+        # caller holds self.lock; returns the frames and how to encode them,
+        # which encode() then does outside the lock
+        frames, size = [], 0
+        while size < COALESCE_BYTES:
+            frame = self._pop()
+            if frame is None:
+                break
+            frames.append(frame)
+            size += len(frame)
+        plain = min(self.plain, len(frames))
+        self.plain -= plain
+        return frames, plain, self.deflater
+
+    @staticmethod
+    def encode(frames, plain, deflater):
+        # Only the writer calls this, so the deflate context is never shared.
+        if deflater is None or plain == len(frames):
+            return b"".join(frames)
+        return b"".join(frames[:plain]) + deflater.pack(b"".join(frames[plain:]))
+
+    def _pop(self):
+        # caller holds self.lock
+        if self.queue:
+            frame = self.queue.popleft()
+        elif self.spilled:
+            frame = self._unspill()
+        else:
+            return None
+        if self.spilled and len(self.queue) < self.maxlen:
+            self.queue.append(self._unspill())
+        return frame
+
+    def _release(self):
+        # caller holds self.lock
+        self.closed = True
+        self.queue.clear()
+        self.spilled = 0
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+    def _wake(self):
+        raise NotImplementedError
+
+    def abort(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+class Connection(Outbound):
+    # Blocking socket drained by a dedicated writer thread.
+    def __init__(self, sock, maxlen=None, policy=None):
+        super().__init__(maxlen, policy)
+        self.sock = sock
+        self.ready = threading.Condition(self.lock)
+        threading.Thread(target=self._writer, daemon=True).start()
+
+    def recv(self, n):
+        return self.sock.recv(n)
+
+    def _wake(self):
+        with self.ready:
+            self.ready.notify()
+
+    def _writer(self):
+        while True:
+            with self.ready:
+                while not self.closed and not self.depth:
+                    self.ready.wait()
+                if self.closed:
+                    return
+            if COALESCE_WINDOW:
+                time.sleep(COALESCE_WINDOW)
+            with self.ready:
+                frames, plain, deflater = self._batch()
+            if not frames:
+                continue
+            data = self.encode(frames, plain, deflater)
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                return self.abort()
+            _wrote(len(frames), len(data), sum(map(len, frames)))
+
+    def abort(self):
+        # Shut the socket down so the reader loop sees EOF and runs cleanup.
+        with self.ready:
+            self._release()
+            self.ready.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.abort()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class AsyncConnection(Outbound):
+    # asyncio StreamWriter drained by a task on the owning loop; send() may be
+    # called from any thread.
+    def __init__(self, writer, maxlen=None, policy=None):
+        super().__init__(maxlen, policy)
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.ready = asyncio.Event()
+        self.task = self.loop.create_task(self._writer())
+
+    def _call(self, fn):
+        if threading.get_ident() == self.loop_thread:
+            fn()
+        else:
+            self.loop.call_soon_threadsafe(fn)
+
+    def _wake(self):
+        self._call(self.ready.set)
+
+    async def _writer(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                if COALESCE_WINDOW:
+                    await asyncio.sleep(COALESCE_WINDOW)
+                self.ready.clear()
+                while True:
+                    with self.lock:
+                        frames, plain, deflater = ([], 0, None) if self.closed else self._batch()
+                    if not frames:
+                        break
+                    data = self.encode(frames, plain, deflater)
+                    self.writer.write(data)
+                    _wrote(len(frames), len(data), sum(map(len, frames)))
+                    await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.abort()
+
+    def abort(self):
+        with self.lock:
+            self._release()
+        self._call(self._abort)
+
+    def _abort(self):
+        self.ready.set()
+        self.writer.transport.abort()
+
+    def close(self):
+        with self.lock:
+            self._release()
+        self._call(self._close)
+
+    def _close(self):
+        self.ready.set()
+        self.writer.close()
+
+def queue_stats(conns):
+    depths = [c.depth for c in conns]
+    with _totals_lock:
+        out = dict(totals)
+    if out.get("writes"):
+        out["frames_per_write"] = round(out["frames_written"] / out["writes"], 2)
+    out.update({
+        "connections": len(depths),
+        "queued": sum(depths),
+        "max_depth": max(depths, default=0),
+        "high_water": max((c.high_water for c in conns), default=0),
+    })
+    return out
@@ -0,0 +1,122 @@
+import collections
+import json
+import mmap
+import os
+import threading
+
+from chatlog import IDX, SEQ, file_name
+
+PAGE_SIZE = 50
+MAX_PAGE = 200
+MAX_OPEN = 256
+
+class _Mapped:
+    # Read-only mmap of a file that only grows; remapped when it has.
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        self.map = None
+        self.size = 0
+
+    def view(self):
+        size = os.fstat(self.f.fileno()).st_size
+        if size != self.size:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.f.fileno(), size, access=mmap.ACCESS_READ) if size else None
+            self.size = size
+        return self.map
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.f.close()
+
+class History:
+    # Pages through the chat log written by chatlog.ChatLog without scanning
+    # it: a channel's or user's seq list is binary searched for the page
+    # bounds, chat.idx turns each seq into an offset, and the records are
+    # sliced out of the mmapped log. Safe to use from any process.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.maps = collections.OrderedDict()
+
+    def _map(self, path):
+        m = self.maps.get(path)
+        if m is None:
+            if not os.path.exists(path):
+                return None
+            m = self.maps[path] = _Mapped(path)
+            if len(self.maps) > MAX_OPEN:
+                self.maps.popitem(last=False)[1].close()
+        else:
+            self.maps.move_to_end(path)
+        return m.view()
+
+    def _entry(self, seq):
+        idx = self._map(os.path.join(self.path, "chat.idx"))
+        pos = (seq - 1) * IDX.size
+        if idx is None or seq < 1 or pos + IDX.size > len(idx):
+            return None
+        return IDX.unpack_from(idx, pos)
+
+    def _record(self, seq):
+        entry = self._entry(seq)
+        log = self._map(os.path.join(self.path, "chat.log"))
+        if entry is None or log is None:
+            return None
+        _, _, offset, length = entry
+        return json.loads(log[offset:offset + length])
+
+    def last_seq(self):
+        with self.lock:
+            idx = self._map(os.path.join(self.path, "chat.idx"))
+            return len(idx) // IDX.size if idx is not None else 0
+
+    def _bisect(self, seqs, n, key, value):
+        # first position whose key is >= value
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(SEQ.unpack_from(seqs, mid * SEQ.size)[0]) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def page(self, seq_file, before=None, after=None, before_ts=None, after_ts=None, limit=PAGE_SIZE):
+        # Returns (records oldest first, whether more exist in that direction).
+        limit = max(1, min(int(limit or PAGE_SIZE), MAX_PAGE))
+        with self.lock:
+            seqs = self._map(seq_file)
+            n = len(seqs) // SEQ.size if seqs is not None else 0
+            # Ignore seqs whose chat.idx entry is not on disk yet.
+            while n and self._entry(SEQ.unpack_from(seqs, (n - 1) * SEQ.size)[0]) is None:
+                n -= 1
+            by_seq = lambda s: s
+            by_ts = lambda s: self._entry(s)[1]
+            if after is not None or after_ts is not None:
+                start = self._bisect(seqs, n, by_seq, int(after) + 1) if after is not None \
+                    else self._bisect(seqs, n, by_ts, float(after_ts) + 1e-6)
+                end = min(start + limit, n)
+                more = end < n
+            else:
+                end = n
+                if before is not None:
+                    end = self._bisect(seqs, n, by_seq, int(before))
+                elif before_ts is not None:
+                    end = self._bisect(seqs, n, by_ts, float(before_ts))
+                start = max(end - limit, 0)
+                more = start > 0
+            out = []
+            for i in range(start, end):
+                r = self._record(SEQ.unpack_from(seqs, i * SEQ.size)[0])
+                if r is not None:
+                    out.append(r)
+            return out, more
+
+    def channel(self, name, **kw):
+        return self.page(os.path.join(self.path, "channels", f"{file_name(name)}.idx"), **kw)
+
+    def user(self, username, **kw):
+        return self.page(os.path.join(self.path, "users", f"{file_name(username)}.idx"), **kw)
@@ -0,0 +1,165 @@
+import bisect
+import collections
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PREFIX = "chat"
+
+now = time.perf_counter
+
+class Histogram:
+    # Fixed buckets, so observe() is a bisect and an increment.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def copy(self):
+        with self.lock:
+            return list(self.counts), self.count, self.sum, self.max
+
+    def quantile(self, q, counts=None, count=None, top=None):
+        # Upper bound of the bucket holding the q-th observation.
+        if counts is None:
+            counts, count, _, top = self.copy()
+        rank, seen = q * count, 0
+        for bound, n in zip(BUCKETS, counts):
+            seen += n
+            if n and seen >= rank:
+                return min(bound, top)
+        return top
+
+    def summary(self):
+        counts, count, total, top = self.copy()
+        ms = lambda s: round(s * 1000, 3)
+        return {"count": count, "avg_ms": ms(total / count) if count else 0,
+                "p50_ms": ms(self.quantile(0.5, counts, count, top)),
+                "p99_ms": ms(self.quantile(0.99, counts, count, top)),
+                "p999_ms": ms(self.quantile(0.999, counts, count, top)),
+                "max_ms": ms(top)}
+
+class Histograms:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_name = {}
+
+    def get(self, name):
+        h = self.by_name.get(name)
+        if h is None:
+            with self.lock:
+                h = self.by_name.setdefault(name, Histogram())
+        return h
+
+    def observe(self, name, seconds):
+        self.get(name).observe(seconds)
+
+    def items(self):
+        with self.lock:
+            return sorted(self.by_name.items())
+
+commands = Histograms()
+lock_wait = Histograms()
+lock_hold = Histograms()
+_counters_lock = threading.Lock()
+counters = collections.Counter()
+
+def count(key, n=1):
+    with _counters_lock:
+        counters[key] += n
+
+class TimedLock:
+    # threading.Lock that records how long callers waited for it and how long
+    # they held it. Only the holder touches self.acquired.
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.wait = lock_wait.get(name)
+        self.hold = lock_hold.get(name)
+        self.acquired = 0.0
+
+    def __enter__(self):
+        t0 = now()
+        self.lock.acquire()
+        self.acquired = now()
+        self.wait.observe(self.acquired - t0)
+        return self
+
+    def __exit__(self, *exc):
+        held = now() - self.acquired
+        self.lock.release()
+        self.hold.observe(held)
+
+def snapshot():
+    with _counters_lock:
+        out = dict(counters)
+    out["commands"] = {name: h.summary() for name, h in commands.items()}
+    out["locks"] = {name: {"wait": h.summary(), "hold": lock_hold.get(name).summary()}
+                    for name, h in lock_wait.items()}
+    return out
+
+def _histogram_lines(metric, label, histograms):
+    lines = [f"# TYPE {metric} histogram"]
+    for name, h in histograms.items():
+        counts, total, seconds, _ = h.copy()
+        cumulative = 0
+        for bound, n in zip(BUCKETS, counts):
+            cumulative += n
+            lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{{label}="{name}",le="+Inf"}} {total}')
+        lines.append(f'{metric}_sum{{{label}="{name}"}} {seconds}')
+        lines.append(f'{metric}_count{{{label}="{name}"}} {total}')
+    return lines
+
+def render(gauges):
+    # Prometheus text format: the histograms and counters kept here plus the
+    # caller's values ({name: value}; names ending in _total are counters).
+    lines = _histogram_lines(f"{PREFIX}_command_seconds", "command", commands)
+    lines += _histogram_lines(f"{PREFIX}_lock_wait_seconds", "lock", lock_wait)
+    lines += _histogram_lines(f"{PREFIX}_lock_hold_seconds", "lock", lock_hold)
+    with _counters_lock:
+        totals = sorted(counters.items())
+    for key, value in totals:
+        lines.append(f"# TYPE {PREFIX}_{key}_total counter")
+        lines.append(f"{PREFIX}_{key}_total {value}")
+    for key, value in sorted(gauges.items()):
+        if value is not None:
+            kind = "counter" if key.endswith("_total") else "gauge"
+            lines.append(f"# TYPE {PREFIX}_{key} {kind}")
+            lines.append(f"{PREFIX}_{key} {value}")
+    return "\n".join(lines) + "\n"
+
+def serve(port, gauges, host="127.0.0.1"):
+    # Plain-text endpoint for scrapers, bound to localhost only.
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                return self.send_error(404)
+            body = render(gauges()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    srv = ThreadingHTTPServer((host, port), Handler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
@@ -0,0 +1,74 @@
+import contextlib
+import json
+import os
+import threading
+
+from chatlog import file_name
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MAILBOX_BYTES = 256 * 1024
+
+class Mailbox:
+    # Per-user file of private messages sent while the user was offline, one
+    # logged record per line in seq order. The chat log writer appends to it
+    # as part of each group commit, login reads a whole box in one go and an
+    # ack cuts everything up to a seq off its front. Boxes are flocked, as
+    # the writer and the readers may be different processes.
+    def __init__(self, path, limit=None):
+        self.path = path
+        self.limit = MAILBOX_BYTES if limit is None else limit
+        self.lock = threading.Lock()
+
+    def _box(self, username):
+        return os.path.join(self.path, f"{file_name(username)}.box")
+
+    @contextlib.contextmanager
+    def _open(self, username, mode):
+        with self.lock, open(self._box(username), mode) as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield f
+
+    def size(self, username):
+        try:
+            return os.path.getsize(self._box(username))
+        except OSError:
+            return 0
+
+    def full(self, username):
+        return self.size(username) >= self.limit
+
+    def append(self, username, lines):
+        # lines: encoded record lines, in seq order
+        os.makedirs(self.path, exist_ok=True)
+        with self._open(username, "ab") as f:
+            f.write(b"".join(lines))
+
+    def read(self, username):
+        if not os.path.exists(self._box(username)):
+            return []
+        with self._open(username, "rb") as f:
+            data = f.read()
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+    def ack(self, username, seq):
+        # Drop the records up to and including seq; later ones, which may
+        # have arrived since the box was read, stay for the next login.
+        if not os.path.exists(self._box(username)):
+            return
+        with self._open(username, "r+b") as f:
+            data = f.read()
+            cut = 0
+            for line in data.splitlines(keepends=True):
+                if line.strip() and json.loads(line)["seq"] > seq:
+                    break
+                cut += len(line)
+            if not cut:
+                return
+            f.seek(0)
+            f.write(data[cut:])
+            f.truncate()
@@ -0,0 +1,95 @@
+import threading
+import time
+
+DEBOUNCE = 2.0  # seconds presence changes are held and coalesced
+
+class Presence:
+    # username -> set of live connections; a user may hold several sessions.
+    # In a multi-worker server, remote counts how many other workers have
+    # the user online.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.remote = {}
+
+    def add(self, username, conn):
+        # True when this is the user's first live session.
+        with self.lock:
+            conns = self.sessions.setdefault(username, set())
+            first = not conns
+            conns.add(conn)
+        return first
+
+    def remove(self, username, conn):
+        # True when the user's last live session went away.
+        with self.lock:
+            conns = self.sessions.get(username)
+            if not conns or conn not in conns:
+                return False
+            conns.discard(conn)
+            if conns:
+                return False
+            del self.sessions[username]
+            return True
+
+    def connections(self, username):
+        with self.lock:
+            return list(self.sessions.get(username, ()))
+
+    def set_remote(self, username, online):
+        with self.lock:
+            n = self.remote.get(username, 0) + (1 if online else -1)
+            if n > 0:
+                self.remote[username] = n
+            else:
+                self.remote.pop(username, None)
+
+    def is_online(self, username):
+        return username in self.sessions or username in self.remote
+
+class Notifier:
+    # Pushes contacts' presence changes to the users watching them. changed()
+    # only marks a user; every interval the marked users' current state is
+    # compared with what watchers were last told, so a connection that drops
+    # and comes back within the window sends nothing, and each watcher is
+    # told about all of its contacts that changed in one push.
+    def __init__(self, presence, watchers, push, interval=None):
+        self.presence = presence
+        self.watchers = watchers    # username -> users with it as a contact
+        self.push = push            # (conns, changes) -> None
+        self.interval = DEBOUNCE if interval is None else interval
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.told = set()           # users watchers last heard were online
+        self.pushed = 0
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def changed(self, username):
+        with self.lock:
+            self.dirty.add(username)
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        per_watcher = {}
+        for u in sorted(dirty):
+            online = self.presence.is_online(u)
+            if online == (u in self.told):
+                continue
+            (self.told.add if online else self.told.discard)(u)
+            for w in self.watchers(u):
+                if w in self.presence.sessions:
+                    per_watcher.setdefault(w, []).append({"user": u, "online": online})
+        for w, changes in per_watcher.items():
+            self.push(self.presence.connections(w), changes)
+        self.pushed += len(per_watcher)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"在线状态推送异常：{e}")
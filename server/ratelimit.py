@@ -0,0 +1,113 @@
+import threading
+import time
+
+# Commands are limited per class; anything not listed here is "other".
+CLASSES = {
+    "chat": "chat", "private_chat": "chat",
+    "register": "auth", "login": "auth", "resume_session": "auth",
+    "reset_password": "auth", "delete_account": "auth",
+    "history": "query", "resume": "query", "list_channels": "query",
+    "list_contacts": "query", "stats": "query",
+}
+# class -> (tokens per second, burst); a rate of 0 leaves the class unlimited.
+RATES = {"chat": (5, 20), "auth": (1, 5), "query": (10, 40), "other": (20, 100)}
+# The same, shared by all of one user's connections.
+USER_RATES = {"chat": (10, 40)}
+# A command that would have to wait longer than this is refused outright.
+MAX_DELAY = 2.0
+# How often per-user buckets that have refilled are dropped.
+SWEEP_INTERVAL = 60.0
+
+def parse_rate(text):
+    # "chat=5/20" -> ("chat", (5.0, 20.0))
+    try:
+        cls, spec = text.split("=", 1)
+        rate, burst = spec.split("/", 1)
+        return cls.strip(), (float(rate), float(burst))
+    except ValueError:
+        raise ValueError(f"rate must look like CLASS=RATE/BURST, not {text!r}")
+
+class Bucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def debt(self, now):
+        # Seconds until the bucket is back at zero after taking one token.
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now):
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+class Limiter:
+    # Token buckets per connection and per user. take() lets a command through
+    # but returns how long the reader should stop reading to stay within
+    # budget; the bucket may run a token into debt, never more, since the
+    # reader pauses as soon as it does. Per-user buckets are shared by several
+    # readers and can fall further behind; past max_delay a command is refused.
+    # They outlive the user's sessions, or logging in again would refill
+    # them, and are dropped only once they are full again anyway.
+    def __init__(self, rates=None, user_rates=None, max_delay=None):
+        self.rates = RATES if rates is None else rates
+        self.user_rates = USER_RATES if user_rates is None else user_rates
+        self.max_delay = MAX_DELAY if max_delay is None else max_delay
+        self.conns = {}
+        self.users = {}
+        self.lock = threading.Lock()
+        self.next_sweep = time.monotonic() + SWEEP_INTERVAL
+
+    @staticmethod
+    def classify(command):
+        return CLASSES.get(command, "other")
+
+    def _bucket(self, table, key, cls, rates):
+        rate, burst = rates.get(cls, (0, 0))
+        if rate <= 0:
+            return None
+        buckets = table.setdefault(key, {})
+        b = buckets.get(cls)
+        if b is None:
+            b = buckets[cls] = Bucket(rate, max(burst, 1))
+        return b
+
+    def needs_user(self, cls):
+        return self.user_rates.get(cls, (0, 0))[0] > 0
+
+    def take(self, conn, user, cls):
+        # None if the command must be refused, else seconds to pause reading.
+        # Only conn's reader touches its buckets; user buckets take the lock.
+        now = time.monotonic()
+        mine = self._bucket(self.conns, conn, cls, self.rates)
+        wait = mine.debt(now) if mine else 0.0
+        if user is None or not self.needs_user(cls):
+            if mine:
+                mine.take()
+            return wait
+        with self.lock:
+            if now >= self.next_sweep:
+                self._sweep(now)
+            shared = self._bucket(self.users, user, cls, self.user_rates)
+            wait = max(wait, shared.debt(now))
+            if wait > self.max_delay:
+                return None
+            shared.take()
+        if mine:
+            mine.take()
+        return wait
+
+    def forget(self, conn):
+        self.conns.pop(conn, None)
+
+    def _sweep(self, now):
+        # caller holds self.lock
+        self.next_sweep = now + SWEEP_INTERVAL
+        for user in [u for u, b in self.users.items() if all(x.full(now) for x in b.values())]:
+            del self.users[user]
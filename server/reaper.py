@@ -0,0 +1,72 @@
+import math
+import threading
+import time
+
+HEARTBEAT = 30      # seconds; advertised to clients in hello_ok
+IDLE_TIMEOUT = 90   # connections silent this long are dropped, 0 to never
+TICK = 1.0
+
+class Reaper:
+    # Timing wheel of idle deadlines. touch() only records the time, so it is
+    # O(1) and lock-free on the hot path; a connection sits in the slot of
+    # the deadline it had when last scheduled and is moved on, or dropped,
+    # when the wheel reaches that slot.
+    def __init__(self, timeout=None, tick=TICK, expire=None):
+        self.timeout = IDLE_TIMEOUT if timeout is None else timeout
+        self.tick = tick
+        self.expire = expire or (lambda conn: conn.abort())
+        self.seen = {}
+        self.lock = threading.Lock()
+        self.slots = [set() for _ in range(math.ceil(self.timeout / tick) + 1)] if self.timeout > 0 else []
+        self.pos = 0
+        self.reaped = 0
+
+    def start(self):
+        if self.slots:
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _schedule(self, conn, deadline, now):
+        # caller holds self.lock
+        ahead = min(max(1, math.ceil((deadline - now) / self.tick)), len(self.slots) - 1)
+        self.slots[(self.pos + ahead) % len(self.slots)].add(conn)
+
+    def add(self, conn):
+        if not self.slots:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.seen[conn] = now
+            self._schedule(conn, now + self.timeout, now)
+
+    def touch(self, conn):
+        if conn in self.seen:
+            self.seen[conn] = time.monotonic()
+
+    def remove(self, conn):
+        # Its slot entry is discarded when the wheel gets there.
+        self.seen.pop(conn, None)
+
+    def advance(self):
+        now = time.monotonic()
+        idle = []
+        with self.lock:
+            self.pos = (self.pos + 1) % len(self.slots)
+            due, self.slots[self.pos] = self.slots[self.pos], set()
+            for conn in due:
+                last = self.seen.get(conn)
+                if last is None:
+                    continue
+                if now - last >= self.timeout:
+                    # remove() does not take the lock, so conn may be gone
+                    if self.seen.pop(conn, None) is not None:
+                        idle.append(conn)
+                else:
+                    self._schedule(conn, last + self.timeout, now)
+        self.reaped += len(idle)
+        for conn in idle:
+            self.expire(conn)
+
+    def _run(self):
+        while True:
+            time.sleep(self.tick)
+            self.advance()
@@ -1,73 +1,212 @@
 
 import socket
 import threading
+import asyncio
 import argparse
-import json
+import collections
 import os
 import time
 import random
+import signal
 import string
+import sys
 
+import authpool
+import bus as busmod
+import chatlog
+import connection
+import framing
+import offline
+import metrics
+import ratelimit
+import reaper as reapermod
+import sessions as sessionsmod
+import user_manager
+from channels import Channels, DEFAULT as DEFAULT_CHANNEL, valid_name
+from connection import Connection, AsyncConnection
+from framing import Frame, FrameTooLarge, PROTOCOLS, COMPRESSIONS, Deflater, Inflater
+from history import History
+import presence as presencemod
+from presence import Presence
 from user_manager import (
     register_user, login_user, reset_password_with_code,
-    delete_user_with_code, add_contact, remove_contact, list_contacts
+    delete_user_with_code, add_contact, remove_contact, list_contacts, list_watchers,
+    user_exists, session_stamp
 )
 
-clients_lock = threading.Lock()
+clients_lock = metrics.TimedLock("clients_lock")
 clients = {}
+presence = Presence()
+channels = Channels()
 LOG_DIR = "logs"
-os.makedirs(LOG_DIR, exist_ok=True)
+chat_log = None
+auth_pool = None
+bus = None
+reaper = None
+notifier = None
+sessions = None
+limiter = ratelimit.Limiter()
+history = History(LOG_DIR)
+mailbox = offline.Mailbox(os.path.join(LOG_DIR, "mailboxes"))
+# Recently delivered chat events in seq order, for resume after reconnect.
+RING_SIZE = 10000
+# A graceful restart (SIGHUP) asks clients to come back after a random delay
+# of up to RECONNECT_SPREAD seconds and gives their queues DRAIN_TIMEOUT to empty.
+RECONNECT_SPREAD = 10.0
+DRAIN_TIMEOUT = 5.0
+graceful = False
+# Stream compression offered to clients that ask for it in hello.
+COMPRESSION = True
+# Users allowed to read server internals with the stats command.
+ADMINS = set()
+RESUME_MAX = 500
+recent = collections.deque(maxlen=RING_SIZE)
+recent_lock = threading.Lock()
 
 def send_json(conn, obj):
-    try:
-        conn.sendall((json.dumps(obj) + "\n").encode())
-    except:
-        cleanup(conn)
+    conn.send(Frame(obj))
 
 def get_username(conn):
     with clients_lock:
         return clients.get(conn, {}).get("username")
 
-def broadcast_chat(username, msg):
-    ts = int(time.time())
-    line = f"{ts} {username}: {msg}\n"
-    open(os.path.join(LOG_DIR, "global.log"), "a", encoding="utf-8").write(line)
-    with clients_lock:
-        for _, info in clients.items():
-            u = info.get("username")
-            if u:
-                open(os.path.join(LOG_DIR, f"{u}.log"), "a", encoding="utf-8").write(line)
-    with clients_lock:
-        for c in list(clients.keys()):
-            send_json(c, {"type": "chat", "from": username, "message": msg})
+def announce(u, online):
+    # A user's first session opened or last one closed on this worker.
+    notifier.changed(u)
+    bus.publish({"op": "presence", "user": u, "online": online})
+
+def broadcast_chat(username, msg, channel=DEFAULT_CHANNEL):
+    bus.publish({"op": "chat", "channel": channel, "from": username, "message": msg})
+
+def message(event, viewer=None):
+    # Client-facing form of a chat event or logged record. Private messages
+    # read "to" for their sender and "from" for everyone else.
+    if "to" not in event:
+        m = {"type": "chat", "channel": event.get("channel", DEFAULT_CHANNEL),
+             "from": event["from"], "message": event["message"], "seq": event.get("seq")}
+    elif viewer == event["from"]:
+        m = {"type": "private_chat", "to": event["to"], "message": event["message"], "seq": event.get("seq")}
+    else:
+        m = {"type": "private_chat", "from": event["from"], "message": event["message"], "seq": event.get("seq")}
+    if "ts" in event:
+        m["ts"] = event["ts"]
+    return m
+
+def deliver(event):
+    # Called by the bus for every chat event, whichever worker it came from.
+    op = event.get("op")
+    if op == "presence":
+        presence.set_remote(event["user"], event["online"])
+        return notifier.changed(event["user"])
+    if op not in ("chat", "private"):
+        return
+    with recent_lock:
+        recent.append(event)
+    if op == "chat":
+        targets = [(channels.members(event.get("channel", DEFAULT_CHANNEL)), Frame(message(event)))]
+    else:
+        # An offline-flagged message reaches its recipient through the mailbox.
+        to = () if event.get("offline") else presence.connections(event["to"])
+        targets = [(to, Frame(message(event))),
+                   (presence.connections(event["from"]), Frame(message(event, event["from"])))]
+    for conns, frame in targets:
+        for c in conns:
+            c.send(frame)
 
 def cleanup(conn):
-    try:
-        conn.close()
-    except:
-        pass
+    reaper.remove(conn)
+    limiter.forget(conn)
+    conn.close()
     with clients_lock:
-        clients.pop(conn, None)
+        info = clients.pop(conn, None)
+        u = info and info.get("username")
+        if u and presence.remove(u, conn):
+            announce(u, False)
+        for name in (info or {}).get("channels", ()):
+            channels.leave(name, conn)
 
-def parse_line(line):
-    try:
-        return json.loads(line)
-    except:
-        return {"type": "error", "message": "Invalid JSON"}
+def cmd_hello(conn, cmd):
+    proto = cmd.get("proto", "json")
+    if proto not in PROTOCOLS:
+        return send_json(conn, {"type": "error", "message": f"Unsupported protocol {proto}."})
+    # Frames after this one are read with the new framing; the reply still
+    # goes out in the old one and everything queued after it in the new.
+    conn.framer.proto = proto
+    # Compression, if both sides want it, likewise starts after hello_ok;
+    # anything the client sent after hello is already compressed.
+    compress = cmd.get("compress") if COMPRESSION and cmd.get("compress") in COMPRESSIONS else None
+    if compress:
+        conn.inflater = Inflater(connection.MAX_FRAME)
+        conn.framer.feed(conn.inflater.feed(conn.framer.take_rest()))
+    # heartbeat tells the client how often to ping when it has nothing else
+    # to send; connections silent for much longer are reaped.
+    conn.send(Frame({"type": "hello_ok", "proto": proto, "heartbeat": reapermod.HEARTBEAT, "compress": compress}),
+              switch_to=proto, deflater=compress and Deflater())
 
 def cmd_register(conn, cmd):
     ok, res = register_user(cmd.get("username", ""), cmd.get("password", ""))
     send_json(conn, {"type": "register_ok", "recovery_codes": res} if ok else {"type": "error", "message": res})
 
+def attach(conn, u):
+    # Bind conn to u after a login or session resume; False if it is gone.
+    with clients_lock:
+        info = clients.get(conn)
+        if info is None:
+            return False
+        prev, info["username"] = info.get("username"), u
+        if prev and prev != u and presence.remove(prev, conn):
+            announce(prev, False)
+        if presence.add(u, conn):
+            announce(u, True)
+        if not info["channels"]:
+            info["channels"].add(DEFAULT_CHANNEL)
+            channels.join(DEFAULT_CHANNEL, conn)
+    return True
+
+def logged_in(conn, u, message, token, expires):
+    send_json(conn, {"type": "login_ok", "message": message, "last_seq": latest_seq(),
+                     "session": token, "session_expires": expires})
+    # Messages the bus flagged offline before this login may not be in the
+    # box yet; read it once the log has caught up.
+    bus.sync(lambda: deliver_mailbox(conn, u))
+
 def cmd_login(conn, cmd):
     ok, res = login_user(cmd.get("username", ""), cmd.get("password", ""))
     if ok:
-        with clients_lock:
-            clients[conn] = {"username": cmd.get("username", "").strip()}
-        send_json(conn, {"type": "login_ok", "message": res})
+        u = cmd.get("username", "").strip()
+        if attach(conn, u):
+            logged_in(conn, u, res, *sessions.issue(u, session_stamp(u)))
     else:
         send_json(conn, {"type": "error", "message": res})
 
+def cmd_resume_session(conn, cmd):
+    # Re-authenticates with a token from an earlier login_ok: a table lookup
+    # (or one HMAC after a restart) instead of the password check.
+    token = cmd.get("token")
+    session = token and sessions.check(token, session_stamp)
+    if not session:
+        return send_json(conn, {"type": "error", "message": "Session expired, please log in again."})
+    u, expires = session
+    if attach(conn, u):
+        logged_in(conn, u, "Session resumed.", token, expires)
+
+def deliver_mailbox(conn, u):
+    # Everything sent to u while offline, in one frame; the client acks the
+    # last seq and the box is cut down to what came after it.
+    records = mailbox.read(u)
+    if records:
+        send_json(conn, {"type": "mailbox", "messages": [message(r, u) for r in records],
+                         "last_seq": records[-1]["seq"]})
+
+def cmd_mailbox_ack(conn, cmd):
+    u = get_username(conn)
+    if not u:
+        return send_json(conn, {"type": "error", "message": "Please login first."})
+    try:
+        mailbox.ack(u, int(cmd.get("seq", 0)))
+    except (TypeError, ValueError):
+        send_json(conn, {"type": "error", "message": "Invalid mailbox ack."})
+
 def cmd_reset(conn, cmd):
     ok, res = reset_password_with_code(
         cmd.get("username", ""), cmd.get("recovery_code", ""), cmd.get("new_password", "")
@@ -78,13 +217,65 @@ def cmd_delete(conn, cmd):
     ok, res = delete_user_with_code(cmd.get("username", ""), cmd.get("recovery_code", ""))
     send_json(conn, {"type": "delete_ok", "message": res} if ok else {"type": "error", "message": res})
 
+def offload(handler):
+    # Run CPU-heavy auth handlers on the bounded auth pool, not the connection's reader.
+    # Its latency is recorded as "<command>:auth", from submit to reply.
+    def run(conn, cmd, queued):
+        handler(conn, cmd)
+        metrics.commands.observe(f"{cmd.get('type')}:auth", metrics.now() - queued)
+    def submit(conn, cmd):
+        if not auth_pool.submit(run, conn, cmd, metrics.now()):
+            send_json(conn, {"type": "error", "message": "Server busy, please retry."})
+    return submit
+
 def cmd_chat(conn, cmd):
     u = get_username(conn)
     if not u:
         return send_json(conn, {"type": "error", "message": "Please login first."})
     msg = str(cmd.get("message", "")).strip()
+    channel = cmd.get("channel") or DEFAULT_CHANNEL
+    with clients_lock:
+        joined = channel in clients.get(conn, {}).get("channels", ())
+    if not joined:
+        return send_json(conn, {"type": "error", "message": f"Join #{channel} first."})
     if msg:
-        broadcast_chat(u, msg)
+        broadcast_chat(u, msg, channel)
+
+def cmd_join(conn, cmd):
+    if not get_username(conn):
+        return send_json(conn, {"type": "error", "message": "Please login first."})
+    name = str(cmd.get("channel", "")).strip()
+    if not valid_name(name):
+        return send_json(conn, {"type": "error", "message": "Channel names are 1-32 letters, digits, - or _."})
+    with clients_lock:
+        info = clients.get(conn)
+        if info is None:
+            return
+        info["channels"].add(name)
+        channels.join(name, conn)
+    send_json(conn, {"type": "join_ok", "channel": name})
+
+def cmd_leave(conn, cmd):
+    name = str(cmd.get("channel", "")).strip()
+    with clients_lock:
+        info = clients.get(conn)
+        if not info or name not in info["channels"]:
+            return send_json(conn, {"type": "error", "message": f"Not in #{name}."})
+        info["channels"].discard(name)
+        channels.leave(name, conn)
+    send_json(conn, {"type": "leave_ok", "channel": name})
+
+def cmd_list_channels(conn, cmd):
+    if not get_username(conn):
+        return send_json(conn, {"type": "error", "message": "Please login first."})
+    with clients_lock:
+        joined = sorted(clients.get(conn, {}).get("channels", ()))
+    counts = channels.counts()
+    send_json(conn, {
+        "type": "list_channels_ok",
+        "joined": joined,
+        "channels": [{"name": n, "members": c} for n, c in sorted(counts.items())],
+    })
 
 def cmd_private_chat(conn, cmd):
     sender = get_username(conn)
@@ -92,16 +283,14 @@ def cmd_private_chat(conn, cmd):
     msg = cmd.get("message", "").strip()
     if not sender or not target or not msg:
         return send_json(conn, {"type": "error", "message": "Invalid private chat request."})
-    with clients_lock:
-        found = False
-        for c, info in clients.items():
-            if info.get("username") == target:
-                send_json(c, {"type": "private_chat", "from": sender, "message": msg})
-                send_json(conn, {"type": "private_chat", "to": target, "message": msg})
-                found = True
-                break
-        if not found:
-            send_json(conn, {"type": "error", "message": f"User {target} not online."})
+    # The bus decides whether the message goes to the mailbox, in order with
+    # logins; this only turns away ones that could not be kept.
+    if not presence.is_online(target):
+        if not user_exists(target):
+            return send_json(conn, {"type": "error", "message": f"User {target} does not exist."})
+        if mailbox.full(target):
+            return send_json(conn, {"type": "error", "message": f"Mailbox of {target} is full."})
+    bus.publish({"op": "private", "from": sender, "to": target, "message": msg})
 
 def cmd_add_contact(conn, cmd):
     u = get_username(conn)
@@ -124,10 +313,86 @@ def cmd_list_contacts(conn, cmd):
     ok, contacts = list_contacts(u)
     if not ok:
         return send_json(conn, {"type": "error", "message": "Failed to list contacts."})
-    online = {info.get("username"): True for _, info in clients.items()}
     send_json(conn, {
         "type": "list_contacts_ok",
-        "contacts": [{"username": c, "online": online.get(c, False)} for c in contacts]
+        "contacts": [{"username": c, "online": presence.is_online(c)} for c in contacts]
+    })
+
+def cmd_history(conn, cmd):
+    u = get_username(conn)
+    if not u:
+        return send_json(conn, {"type": "error", "message": "Please login first."})
+    scope = cmd.get("scope", "channel")
+    try:
+        page = {k: cmd[k] for k in ("before", "after", "before_ts", "after_ts", "limit") if cmd.get(k) is not None}
+        if scope == "user":
+            messages, more = history.user(u, **page)
+        elif scope == "channel":
+            channel = cmd.get("channel") or DEFAULT_CHANNEL
+            with clients_lock:
+                joined = channel in clients.get(conn, {}).get("channels", ())
+            if not joined:
+                return send_json(conn, {"type": "error", "message": f"Join #{channel} first."})
+            messages, more = history.channel(channel, **page)
+        else:
+            return send_json(conn, {"type": "error", "message": "History scope must be channel or user."})
+    except (TypeError, ValueError):
+        return send_json(conn, {"type": "error", "message": "Invalid history request."})
+    reply = {"type": "history_ok", "scope": scope, "messages": [message(r, u) for r in messages], "more": more}
+    if scope == "channel":
+        reply["channel"] = channel
+    send_json(conn, reply)
+
+def latest_seq():
+    with recent_lock:
+        if recent:
+            return recent[-1]["seq"]
+    return history.last_seq()
+
+def missed_since(u, joined, last):
+    # Events after seq `last` that u would have received, oldest first, at
+    # most RESUME_MAX of them. Served from the ring buffer when it still
+    # reaches back to `last`, otherwise from the history index.
+    relevant = lambda e: e.get("channel", DEFAULT_CHANNEL) in joined if "to" not in e else u in (e["from"], e["to"])
+    gap, covered = [], False
+    with recent_lock:
+        if recent and recent[0]["seq"] <= last + 1:
+            covered = True
+            for e in reversed(recent):
+                if e["seq"] <= last:
+                    break
+                if relevant(e):
+                    gap.append(e)
+    if covered:
+        gap.reverse()
+        return gap[:RESUME_MAX], len(gap) > RESUME_MAX
+    pages = [history.channel(name, after=last, limit=RESUME_MAX) for name in joined]
+    pages.append(history.user(u, after=last, limit=RESUME_MAX))
+    merged = sorted((r for records, _ in pages for r in records), key=lambda r: r["seq"])
+    # Pages are capped separately; past the end of the shortest one that was
+    # cut off, the others would skip its records, and the client resumes from
+    # the last seq it gets.
+    ends = [records[-1]["seq"] for records, more in pages if more and records]
+    if ends:
+        merged = [r for r in merged if r["seq"] <= min(ends)]
+    return merged[:RESUME_MAX], len(merged) > RESUME_MAX or bool(ends)
+
+def cmd_resume(conn, cmd):
+    u = get_username(conn)
+    if not u:
+        return send_json(conn, {"type": "error", "message": "Please login first."})
+    try:
+        last = int(cmd.get("last_seq", 0))
+    except (TypeError, ValueError):
+        return send_json(conn, {"type": "error", "message": "Invalid resume request."})
+    with clients_lock:
+        joined = set(clients.get(conn, {}).get("channels", ()))
+    events, more = missed_since(u, joined, last)
+    send_json(conn, {
+        "type": "resume_ok",
+        "messages": [message(e, u) for e in events],
+        "last_seq": events[-1]["seq"] if events else last,
+        "more": more,
     })
 
 def cmd_get_code(conn, cmd):
@@ -138,61 +403,453 @@ def cmd_get_code(conn, cmd):
     ttl = 60
     send_json(conn, {"type": "your_code", "code": code, "ttl": ttl})
 
+def log_lag():
+    # Records waiting for the log writer and the age of the oldest; the chat
+    # log lives in the cluster parent, so workers report nothing.
+    if chat_log is None:
+        return None, None
+    pending, age = chat_log.lag()
+    return pending, round(age, 4)
+
+def cmd_stats(conn, cmd):
+    u = get_username(conn)
+    if not u:
+        return send_json(conn, {"type": "error", "message": "Please login first."})
+    if u not in ADMINS:
+        return send_json(conn, {"type": "error", "message": "Stats are for admins only."})
+    with clients_lock:
+        conns = list(clients)
+    pending, age = log_lag()
+    send_json(conn, {
+        "type": "stats_ok",
+        "auth_pool": auth_pool.stats(),
+        "queues": connection.queue_stats(conns),
+        "idle_reaped": reaper.reaped,
+        "presence_pushed": notifier.pushed,
+        "sessions": sessions.stats(),
+        "rate_limits": {"connection": limiter.rates, "user": limiter.user_rates},
+        "log_pending": pending,
+        "log_lag_seconds": age,
+        "metrics": metrics.snapshot(),
+    })
+
+def gauges():
+    # Values for the metrics endpoint besides those metrics.py keeps itself.
+    with clients_lock:
+        conns = list(clients)
+    queues = connection.queue_stats(conns)
+    pool = auth_pool.stats() if auth_pool else {}
+    pending, age = log_lag()
+    out = {
+        "connections": queues["connections"],
+        "outbound_queued": queues["queued"],
+        "outbound_max_depth": queues["max_depth"],
+        "auth_running": pool.get("running"),
+        "auth_queued": pool.get("queued"),
+        "idle_reaped_total": reaper.reaped if reaper else None,
+        "log_pending": pending,
+        "log_lag_seconds": age,
+    }
+    for key in ("bytes_out", "bytes_out_uncompressed", "writes", "frames_written", "dropped", "spilled", "slow_disconnects"):
+        out[f"{key}_total"] = queues.get(key, 0)
+    return out
+
 COMMANDS = {
-    "register": cmd_register,
-    "login": cmd_login,
-    "reset_password": cmd_reset,
-    "delete_account": cmd_delete,
+    "hello": cmd_hello,
+    "register": offload(cmd_register),
+    "login": offload(cmd_login),
+    "resume_session": cmd_resume_session,
+    "reset_password": offload(cmd_reset),
+    "delete_account": offload(cmd_delete),
     "chat": cmd_chat,
+    "join": cmd_join,
+    "leave": cmd_leave,
+    "list_channels": cmd_list_channels,
     "private_chat": cmd_private_chat,
     "add_contact": cmd_add_contact,
     "remove_contact": cmd_remove_contact,
     "list_contacts": cmd_list_contacts,
     "get_code": cmd_get_code,
+    "history": cmd_history,
+    "resume": cmd_resume,
+    "mailbox_ack": cmd_mailbox_ack,
+    "stats": cmd_stats,
     "ping": lambda c, _: send_json(c, {"type": "pong"})
 }
 
 def handle_command(conn, cmd):
-    handler = COMMANDS.get(cmd.get("type"))
+    name = cmd.get("type")
+    handler = COMMANDS.get(name)
     if handler:
+        t0 = metrics.now()
         handler(conn, cmd)
+        metrics.commands.observe(name, metrics.now() - t0)
     else:
+        metrics.count("unknown_commands")
         send_json(conn, {"type": "error", "message": "Unknown command"})
 
-def handle_client(conn, addr):
+def admit(conn, cmd):
+    # None to refuse cmd, else how long its reader should stop reading.
+    cls = limiter.classify(cmd.get("type"))
+    user = get_username(conn) if limiter.needs_user(cls) else None
+    wait = limiter.take(conn, user, cls)
+    if wait is None:
+        metrics.count(f"rate_limited_{cls}")
+    elif wait:
+        metrics.count(f"throttled_{cls}")
+    return wait
+
+def consume(conn, data=b""):
+    # Handles the commands buffered for conn and returns 0, or the seconds to
+    # wait before calling again with no data when conn is over its budget;
+    # the rest of the buffer stays unparsed and the socket unread meanwhile.
+    reaper.touch(conn)
+    if data:
+        metrics.count("bytes_in", len(data))
+    try:
+        conn.framer.feed(conn.inflater.feed(data) if conn.inflater and data else data)
+        for cmd in conn.framer.messages():
+            wait = admit(conn, cmd)
+            if wait is None:
+                send_json(conn, {"type": "error", "message": "Rate limit exceeded, slow down."})
+                continue
+            handle_command(conn, cmd)
+            if wait:
+                return wait
+    except FrameTooLarge:
+        # The stream can't be resynchronised past a frame we won't buffer.
+        metrics.count("oversized_frames")
+        conn.abort()
+    return 0
+
+def handle_client(sock, addr):
+    conn = Connection(sock)
     with clients_lock:
-        clients[conn] = {"username": None}
+        clients[conn] = {"username": None, "channels": set()}
+    reaper.add(conn)
     print(f"新设备连接：{addr}")  # 新增：连接日志
-    buf = ""
     try:
         while True:
             data = conn.recv(4096)
             if not data:
                 break
-            buf += data.decode(errors="ignore")
-            while "\n" in buf:
-                line, buf = buf.split("\n", 1)
-                if line.strip():
-                    handle_command(conn, parse_line(line))
+            wait = consume(conn, data)
+            while wait:
+                time.sleep(wait)
+                wait = consume(conn)
     except Exception as e:
         print(f"连接异常：{addr}，原因：{e}")
     finally:
         cleanup(conn)
         print(f"设备断开：{addr}")
 
-def start_server(host, port):
+class Restart(Exception):
+    pass
+
+def request_restart(signum, frame):
+    raise Restart()
+
+def listener(host, port, reuse_port=False, fd=None, backlog=socket.SOMAXCONN):
+    # fd is a listening socket inherited from the process this one replaced.
+    if fd is not None:
+        return socket.socket(fileno=fd)
     srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     srv.bind((host, port))
-    srv.listen()
+    srv.listen(backlog)
+    return srv
+
+def announce_restart():
+    # Each client gets its own delay so they don't all log in at once.
+    with clients_lock:
+        conns = list(clients)
+    for c in conns:
+        send_json(c, {"type": "reconnect", "delay": round(random.uniform(1, RECONNECT_SPREAD), 2)})
+    print(f"正在平滑重启，通知 {len(conns)} 个连接稍后重连")
+    return conns
+
+def drain():
+    conns = announce_restart()
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while any(c.depth for c in conns) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    for c in conns:
+        c.close()
+
+async def drain_async():
+    conns = announce_restart()
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while any(c.depth for c in conns) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    await close_async(conns)
+
+async def close_async(conns):
+    for c in conns:
+        c.close()
+    # let the handlers see EOF and clean up before asyncio.run() cancels them
+    deadline = time.monotonic() + 1
+    while clients and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+def start_server(host, port, reuse_port=False, fd=None):
+    # Returns the listening socket, still open, once a restart was requested.
+    srv = listener(host, port, reuse_port, fd)
+    if graceful:
+        signal.signal(signal.SIGHUP, request_restart)
     print(f"服务器已启动，监听地址：{host}:{port}")  # 新增：启动信息
-    while True:
-        conn, addr = srv.accept()
-        threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+    try:
+        while True:
+            conn, addr = srv.accept()
+            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+    except Restart:
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        drain()
+        return srv
+
+async def handle_client_async(reader, writer):
+    conn = AsyncConnection(writer)
+    addr = writer.get_extra_info("peername")
+    with clients_lock:
+        clients[conn] = {"username": None, "channels": set()}
+    reaper.add(conn)
+    print(f"新设备连接：{addr}")
+    try:
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            wait = consume(conn, data)
+            while wait:
+                await asyncio.sleep(wait)
+                wait = consume(conn)
+            await asyncio.sleep(0)  # let writer tasks drain what this chunk queued
+    except Exception as e:
+        print(f"连接异常：{addr}，原因：{e}")
+    finally:
+        cleanup(conn)
+        print(f"设备断开：{addr}")
+
+def raise_fd_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+async def serve_async(host, port, reuse_port=False, fd=None):
+    # asyncio closes the sockets it serves on, so it gets a duplicate and the
+    # original stays listening, for the next process, after we stop accepting.
+    sock = listener(host, port, reuse_port, fd, backlog=4096)
+    srv = await asyncio.start_server(handle_client_async, sock=sock.dup())
+    print(f"服务器已启动（asyncio），监听地址：{host}:{port}")
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()   # True to restart, False to exit
+    def stop(restarting):
+        if not stopped.done():
+            stopped.set_result(restarting)
+    if graceful:
+        loop.add_signal_handler(signal.SIGHUP, stop, True)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop, False)
+    restarting = await stopped
+    srv.close()
+    if not restarting:
+        with clients_lock:
+            conns = list(clients)
+        await close_async(conns)
+        return None
+    await drain_async()
+    return sock
+
+def start_server_async(host, port, reuse_port=False, fd=None):
+    raise_fd_limit()
+    return asyncio.run(serve_async(host, port, reuse_port, fd))
+
+ENGINES = {"thread": start_server, "asyncio": start_server_async}
+
+def push_presence(conns, changes):
+    # One online_status frame per contact, the shape clients have always read.
+    frames = [Frame(dict(c, type="online_status")) for c in changes]
+    for c in conns:
+        for frame in frames:
+            c.send(frame)
+
+def start_housekeeping(args):
+    global reaper, notifier, sessions
+    sessions = sessionsmod.Sessions(sessionsmod.load_key(args.session_key), args.session_ttl)
+    reaper = reapermod.Reaper(args.idle_timeout)
+    reaper.start()
+    notifier = presencemod.Notifier(presence, list_watchers, push_presence, args.presence_debounce)
+    notifier.start()
+
+def start_metrics(port):
+    if port:
+        metrics.serve(port, gauges)
+        print(f"指标服务已启动：http://127.0.0.1:{port}/metrics")
+
+def restart(srv):
+    # Become a fresh copy of this server that inherits the listening socket.
+    # Clients connecting in between wait in its backlog.
+    auth_pool.executor.shutdown(wait=True)
+    chat_log.close()
+    fd = srv.fileno()
+    os.set_inheritable(fd, True)
+    argv = list(sys.argv)
+    if "--listen-fd" in argv:
+        i = argv.index("--listen-fd")
+        del argv[i:i + 2]
+    print("日志已写入，重新启动服务器")
+    os.execv(sys.executable, [sys.executable] + argv + ["--listen-fd", str(fd)])
+
+def run_single(args):
+    # With --graceful, SIGHUP restarts without refusing connections: see restart().
+    global chat_log, auth_pool, bus, graceful
+    user_manager.configure(args.user_store, args.user_db)
+    chat_log = chatlog.ChatLog(LOG_DIR, args.log_flush, args.log_fsync, mailbox)
+    bus = busmod.LocalBus(chat_log, deliver, presence.is_online)
+    auth_pool = authpool.AuthPool(args.auth_workers, args.auth_queue)
+    start_housekeeping(args)
+    start_metrics(args.metrics_port)
+    graceful = args.graceful and hasattr(signal, "SIGHUP")
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        srv = ENGINES[args.engine](args.host, args.port, fd=args.listen_fd)
+        if srv is not None:
+            restart(srv)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Clients already saw what is still waiting for the next group commit.
+        chat_log.close()
+
+def run_worker(args, n):
+    global auth_pool, bus
+    user_manager.configure(args.user_store, args.user_db)
+    bus = busmod.RemoteBus(args.bus_path, deliver)
+    auth_pool = authpool.AuthPool(args.auth_workers, args.auth_queue)
+    start_housekeeping(args)
+    start_metrics(args.metrics_port and args.metrics_port + 1 + n)
+    print(f"工作进程 {n} 启动，PID {os.getpid()}")
+    ENGINES[args.engine](args.host, args.port, reuse_port=True)
+
+def run_cluster(args):
+    # Workers are forked before the parent starts any threads; each binds the
+    # port with SO_REUSEPORT and the kernel spreads connections across them.
+    # The parent runs the bus hub and owns the chat log.
+    global chat_log
+    hub_sock = busmod.listen(args.bus_path)
+    sessionsmod.load_key(args.session_key)  # create it once, before workers race to
+    pids = []
+    for n in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            hub_sock.close()
+            try:
+                run_worker(args, n)
+            finally:
+                os._exit(1)
+        pids.append(pid)
+    chat_log = chatlog.ChatLog(LOG_DIR, args.log_flush, args.log_fsync, mailbox)
+    busmod.Hub(hub_sock, chat_log).start()
+    start_metrics(args.metrics_port)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while pids:
+            pid, status = os.wait()
+            if pid in pids:
+                pids.remove(pid)
+                print(f"工作进程 {pid} 已退出，状态 {status}")
+    except KeyboardInterrupt:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    finally:
+        chat_log.close()
 
 if __name__ == "__main__":
     p = argparse.ArgumentParser()
     p.add_argument("--host", default="0.0.0.0")
     p.add_argument("--port", type=int, default=5000)
+    p.add_argument("--engine", choices=sorted(ENGINES), default="thread")
+    p.add_argument("--queue-size", type=int, default=connection.QUEUE_SIZE,
+                   help="outbound frames buffered per connection")
+    p.add_argument("--slow-policy", choices=connection.POLICIES, default=connection.POLICY,
+                   help="what to do when a connection's outbound queue is full")
+    p.add_argument("--coalesce-ms", type=float, default=connection.COALESCE_WINDOW * 1000,
+                   help="how long a connection's writer waits to batch frames into one write")
+    p.add_argument("--coalesce-bytes", type=int, default=connection.COALESCE_BYTES)
+    p.add_argument("--log-flush", type=float, default=chatlog.FLUSH_INTERVAL,
+                   help="seconds between chat log group commits")
+    p.add_argument("--log-fsync", choices=chatlog.FSYNC_POLICIES, default=chatlog.FSYNC)
+    p.add_argument("--user-store", choices=["json", "sqlite"], default="json")
+    p.add_argument("--user-db", help="path of the user store (users.json or users.db)")
+    p.add_argument("--auth-workers", type=int, default=authpool.POOL_SIZE)
+    p.add_argument("--auth-queue", type=int, default=authpool.QUEUE_LIMIT,
+                   help="auth requests allowed to wait before replying 'server busy'")
+    p.add_argument("--workers", type=int, default=1,
+                   help="worker processes sharing the port via SO_REUSEPORT (needs --user-store sqlite)")
+    p.add_argument("--heartbeat", type=float, default=reapermod.HEARTBEAT,
+                   help="seconds between pings a client sends when otherwise idle")
+    p.add_argument("--idle-timeout", type=float,
+                   help="drop connections silent this many seconds (default 3 heartbeats, 0 never)")
+    p.add_argument("--mailbox-bytes", type=int, default=offline.MAILBOX_BYTES,
+                   help="size at which a user's offline mailbox refuses more messages")
+    p.add_argument("--session-ttl", type=float, default=sessionsmod.TTL,
+                   help="seconds a session token from login_ok stays valid")
+    p.add_argument("--session-key", default=sessionsmod.KEY_FILE, help="file holding the token signing key")
+    p.add_argument("--presence-debounce", type=float, default=presencemod.DEBOUNCE,
+                   help="seconds presence changes are coalesced before contacts are told")
+    p.add_argument("--rate", action="append", default=[], metavar="CLASS=RATE/BURST",
+                   help="per-connection command budget for chat, auth, query or other (RATE 0 = unlimited)")
+    p.add_argument("--user-rate", action="append", default=[], metavar="CLASS=RATE/BURST",
+                   help="command budget shared by all of a user's connections")
+    p.add_argument("--max-frame", type=int, default=connection.MAX_FRAME,
+                   help="largest message in bytes a client may send")
+    p.add_argument("--compression", choices=["zlib", "none"], default="zlib",
+                   help="stream compression offered to clients that ask for it")
+    p.add_argument("--compress-min", type=int, default=framing.COMPRESS_MIN,
+                   help="writes smaller than this many bytes are sent uncompressed")
+    p.add_argument("--graceful", action="store_true",
+                   help="restart in place on SIGHUP, keeping the listening socket (single process only)")
+    p.add_argument("--reconnect-spread", type=float, default=RECONNECT_SPREAD,
+                   help="on SIGHUP, clients are told to reconnect within this many seconds")
+    p.add_argument("--drain-timeout", type=float, default=DRAIN_TIMEOUT,
+                   help="on SIGHUP, how long outbound queues get to empty before connections close")
+    p.add_argument("--listen-fd", type=int, help=argparse.SUPPRESS)
+    p.add_argument("--admin", action="append", default=[], metavar="USER",
+                   help="user allowed to run the stats command (repeatable)")
+    p.add_argument("--metrics-port", type=int, default=0,
+                   help="serve plain-text metrics on 127.0.0.1 at this port (workers use the ports after it)")
+    p.add_argument("--bus-path", default=busmod.BUS_PATH, help="unix socket linking the workers")
     args = p.parse_args()
-    start_server(args.host, args.port)
+    if args.workers > 1 and args.user_store != "sqlite":
+        p.error("--workers needs --user-store sqlite so every worker sees the same accounts")
+    connection.QUEUE_SIZE = args.queue_size
+    connection.POLICY = args.slow_policy
+    connection.COALESCE_WINDOW = args.coalesce_ms / 1000
+    connection.COALESCE_BYTES = args.coalesce_bytes
+    connection.MAX_FRAME = args.max_frame
+    mailbox.limit = args.mailbox_bytes
+    RECONNECT_SPREAD = args.reconnect_spread
+    COMPRESSION = args.compression != "none"
+    framing.COMPRESS_MIN = args.compress_min
+    DRAIN_TIMEOUT = args.drain_timeout
+    ADMINS.update(args.admin)
+    try:
+        limiter.rates.update(ratelimit.parse_rate(r) for r in args.rate)
+        limiter.user_rates.update(ratelimit.parse_rate(r) for r in args.user_rate)
+    except ValueError as e:
+        p.error(str(e))
+    reapermod.HEARTBEAT = args.heartbeat
+    if args.idle_timeout is None:
+        args.idle_timeout = 3 * args.heartbeat
+    if args.workers > 1:
+        run_cluster(args)
+    else:
+        run_single(args)
@@ -0,0 +1,109 @@
+import base64
+import collections
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+
+KEY_FILE = "session.key"
+TTL = 24 * 3600
+
+def load_key(path=None):
+    # The signing key survives restarts and is shared by worker processes,
+    # so tokens issued before a restart or by another worker still verify.
+    path = path or KEY_FILE
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, "rb") as f:
+            return f.read()
+    key = secrets.token_bytes(32)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+class Sessions:
+    # Tokens are "user.expiry.nonce.mac", the mac covering the user's stamp
+    # (their password hash) too, so a password reset or account deletion
+    # voids every token issued before it. Verified tokens are cached until
+    # they expire; all tokens share one TTL, so the cache is close to expiry
+    # order and eviction pops from its front until it meets a live one.
+    def __init__(self, key, ttl=None):
+        self.key = key
+        self.ttl = TTL if ttl is None else ttl
+        self.lock = threading.Lock()
+        self.table = collections.OrderedDict()   # token -> (user, expires, stamp)
+        self.issued = self.resumed = self.refused = 0
+
+    def _mac(self, user, expires, nonce, stamp):
+        msg = f"{_b64(user.encode())}.{expires}.{nonce}.{stamp}".encode()
+        return hmac.new(self.key, msg, hashlib.sha256).hexdigest()
+
+    def issue(self, user, stamp):
+        expires = int(time.time() + self.ttl)
+        nonce = secrets.token_hex(8)
+        token = f"{_b64(user.encode())}.{expires}.{nonce}.{self._mac(user, expires, nonce, stamp)}"
+        with self.lock:
+            self._evict()
+            self.table[token] = (user, expires, stamp)
+            self.issued += 1
+        return token, expires
+
+    def check(self, token, stamp_of):
+        # (user, expires) for a valid token, else None. stamp_of(user) gives
+        # the user's current stamp, None once the account is gone.
+        if not isinstance(token, str):
+            with self.lock:
+                self.refused += 1
+            return None
+        with self.lock:
+            self._evict()
+            entry = self.table.get(token)
+        if entry is None:
+            entry = self._parse(token, stamp_of)
+        user = entry and entry[0]
+        if user is None or entry[1] <= time.time() or stamp_of(user) != entry[2]:
+            with self.lock:
+                self.table.pop(token, None)
+                self.refused += 1
+            return None
+        with self.lock:
+            self.resumed += 1
+        return user, entry[1]
+
+    def _parse(self, token, stamp_of):
+        # A token this process has not seen, e.g. issued before a restart.
+        try:
+            user_b64, expires, nonce, mac = token.split(".")
+            user, expires = _unb64(user_b64).decode(), int(expires)
+            mac = mac.encode("ascii")
+        except ValueError:  # includes bad base64, UTF-8 and non-ASCII macs
+            return None
+        stamp = stamp_of(user)
+        if stamp is None or not hmac.compare_digest(mac, self._mac(user, expires, nonce, stamp).encode()):
+            return None
+        with self.lock:
+            self.table[token] = (user, expires, stamp)
+        return user, expires, stamp
+
+    def _evict(self):
+        # caller holds self.lock
+        now = time.time()
+        while self.table:
+            token, (_, expires, _) = next(iter(self.table.items()))
+            if expires > now:
+                break
+            del self.table[token]
+
+    def stats(self):
+        with self.lock:
+            return {"active": len(self.table), "issued": self.issued,
+                    "resumed": self.resumed, "refused": self.refused}
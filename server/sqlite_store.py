@@ -0,0 +1,128 @@
+import argparse
+import sqlite3
+import threading
+
+DB_FILE = "users.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT PRIMARY KEY,
+    uuid TEXT NOT NULL,
+    password TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS recovery_codes (
+    name TEXT NOT NULL REFERENCES users(name) ON DELETE CASCADE,
+    code TEXT NOT NULL,
+    PRIMARY KEY (name, code)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS contacts (
+    owner TEXT NOT NULL REFERENCES users(name) ON DELETE CASCADE,
+    target TEXT NOT NULL,
+    PRIMARY KEY (owner, target)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS contacts_by_target ON contacts(target);
+"""
+
+class SqliteStore:
+    # Same interface as user_manager.JsonStore. Each thread gets its own
+    # connection so readers run concurrently under WAL; writers serialize on
+    # self.lock, which callers also hold for read-modify-write sequences.
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        db = self.db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+
+    def db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA foreign_keys=ON")
+            db.execute("PRAGMA busy_timeout=5000")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def _write(self, *statements):
+        with self.lock:
+            db = self.db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, args in statements:
+                    db.execute(sql, args)
+                db.execute("COMMIT")
+            except:
+                db.execute("ROLLBACK")
+                raise
+
+    def get(self, u):
+        db = self.db()
+        row = db.execute("SELECT uuid, password FROM users WHERE name = ?", (u,)).fetchone()
+        if not row: return None
+        codes = [c for c, in db.execute("SELECT code FROM recovery_codes WHERE name = ? ORDER BY code", (u,))]
+        return {"uuid": row[0], "password": row[1], "recovery_codes": codes}
+
+    def create(self, u, record):
+        # Another worker process may have registered the name since the
+        # caller's check; surface that as KeyError like a duplicate.
+        try:
+            self._insert_user(u, record)
+        except sqlite3.IntegrityError:
+            raise KeyError(u)
+
+    def _insert_user(self, u, record):
+        self._write(
+            ("INSERT INTO users (name, uuid, password) VALUES (?, ?, ?)", (u, record["uuid"], record["password"])),
+            *[("INSERT INTO recovery_codes (name, code) VALUES (?, ?)", (u, c)) for c in record.get("recovery_codes", [])],
+            *[("INSERT INTO contacts (owner, target) VALUES (?, ?)", (u, t)) for t in record.get("contacts", {})],
+        )
+
+    def delete(self, u):
+        self._write(("DELETE FROM users WHERE name = ?", (u,)))
+
+    def set_password(self, u, h):
+        self._write(("UPDATE users SET password = ? WHERE name = ?", (h, u)))
+
+    def set_contact(self, u, target, on):
+        if on:
+            self._write(("INSERT OR IGNORE INTO contacts (owner, target) VALUES (?, ?)", (u, target)))
+        else:
+            self._write(("DELETE FROM contacts WHERE owner = ? AND target = ?", (u, target)))
+
+    def contacts(self, u):
+        return [t for t, in self.db().execute("SELECT target FROM contacts WHERE owner = ? ORDER BY target", (u,))]
+
+    def has_contact(self, u, target):
+        return self.db().execute(
+            "SELECT 1 FROM contacts WHERE owner = ? AND target = ?", (u, target)).fetchone() is not None
+
+    def watchers(self, u):
+        # Served by the contacts_by_target index.
+        return [o for o, in self.db().execute("SELECT owner FROM contacts WHERE target = ? ORDER BY owner", (u,))]
+
+def migrate(json_path, db_path):
+    # One-shot import of users.json (plus any pending journal) into SQLite.
+    from user_manager import JsonStore
+    users = JsonStore(json_path).users
+    store = SqliteStore(db_path)
+    db = store.db()
+    with store.lock:
+        db.execute("BEGIN IMMEDIATE")
+        for u, r in users.items():
+            db.execute("INSERT OR REPLACE INTO users (name, uuid, password) VALUES (?, ?, ?)",
+                       (u, r.get("uuid", ""), r["password"]))
+            db.executemany("INSERT OR IGNORE INTO recovery_codes (name, code) VALUES (?, ?)",
+                           [(u, c) for c in r.get("recovery_codes", [])])
+            db.executemany("INSERT OR IGNORE INTO contacts (owner, target) VALUES (?, ?)",
+                           [(u, t) for t in r.get("contacts", {})])
+        db.execute("COMMIT")
+    return len(users)
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Migrate users.json into a SQLite user store")
+    p.add_argument("source", nargs="?", default="users.json")
+    p.add_argument("target", nargs="?", default=DB_FILE)
+    args = p.parse_args()
+    print(f"Migrated {migrate(args.source, args.target)} users into {args.target}")
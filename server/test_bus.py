@@ -0,0 +1,24 @@
+import threading
+
+from bus import LocalBus
+from chatlog import ChatLog
+from offline import Mailbox
+
+def test_offline_message_is_boxed_before_sync_callback(tmp_path):
+    box = Mailbox(str(tmp_path / "mailboxes"))
+    log = ChatLog(str(tmp_path / "logs"), flush_interval=0.05, mailbox=box)
+    online = {"bob"}
+    delivered = []
+    bus = LocalBus(log, delivered.append, online.__contains__)
+
+    bus.publish({"op": "private", "from": "bob", "to": "a/b", "message": "hi"})
+    bus.publish({"op": "private", "from": "a/b", "to": "bob", "message": "yo"})
+    seen, done = [], threading.Event()
+    bus.sync(lambda: (seen.extend(box.read("a/b")), done.set()))
+    assert done.wait(5)
+    log.close()
+
+    assert [e.get("offline", False) for e in delivered] == [True, False]
+    assert [r["message"] for r in seen] == ["hi"]
+    assert box.read("bob") == []
+    assert sorted(p.name for p in (tmp_path / "mailboxes").iterdir()) == ["~612f62.box"]
@@ -0,0 +1,54 @@
+import os
+
+import chatlog
+from chatlog import ChatLog
+from history import History
+
+def test_unsafe_usernames_stay_inside_the_log_and_keep_the_writer_alive(tmp_path):
+    path = str(tmp_path / "logs")
+    log = ChatLog(path, flush_interval=0)
+    for sender in ("x/y", "../evil", ".."):
+        log.append({"from": sender, "to": "bob", "message": "hi"})
+    log.flush()
+    seq = log.append({"channel": "global", "from": "bob", "message": "still here"})
+    log.flush()
+    assert log.committed == seq
+    log.close()
+
+    assert sorted(os.listdir(path)) == ["channels", "chat.idx", "chat.log", "users"]
+    assert os.listdir(tmp_path) == ["logs"]
+    history = History(path)
+    assert [r["message"] for r in history.user("x/y")[0]] == ["hi"]
+    assert [r["message"] for r in history.user("../evil")[0]] == ["hi"]
+    assert [r["seq"] for r in history.user("bob")[0]] == [1, 2, 3]
+    assert history.channel("global")[0][0]["message"] == "still here"
+
+def test_seqs_continue_after_reopen(tmp_path):
+    path = str(tmp_path / "logs")
+    log = ChatLog(path, flush_interval=0)
+    log.append({"from": "a/b", "to": "c", "message": "one"})
+    log.close()
+    log = ChatLog(path, flush_interval=0)
+    assert log.append({"from": "c", "to": "a/b", "message": "two"}) == 2
+    log.close()
+
+def test_failed_commit_is_rolled_back_and_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(chatlog, "RETRY_DELAY", 0)
+    path = str(tmp_path / "logs")
+    log = ChatLog(path, flush_interval=0)
+    log.append({"channel": "global", "from": "a", "message": "one"})
+    log.flush()
+    write = log.log.write
+    def torn(data):
+        log.log.write = write
+        write(data[:len(data) // 2])
+        log.log.flush()
+        raise OSError(28, "No space left on device")
+    log.log.write = torn
+    log.append({"channel": "global", "from": "a", "message": "two"})
+    log.flush()
+    log.append({"channel": "global", "from": "a", "message": "three"})
+    log.close()
+
+    records, _ = History(path).channel("global")
+    assert [(r["seq"], r["message"]) for r in records] == [(1, "one"), (2, "two"), (3, "three")]
@@ -0,0 +1,20 @@
+import ratelimit
+from ratelimit import Limiter
+
+def test_user_bucket_survives_logout_until_it_refills(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    limiter = Limiter(rates={}, user_rates={"chat": (1, 3)}, max_delay=0)
+    for _ in range(3):
+        assert limiter.take("c1", "alice", "chat") == 0
+    assert limiter.take("c1", "alice", "chat") is None
+    limiter.forget("c1")
+
+    # a fresh connection for the same user gets no new burst
+    assert limiter.take("c2", "alice", "chat") is None
+    limiter.forget("c2")
+
+    now[0] += ratelimit.SWEEP_INTERVAL
+    limiter.take("c3", "bob", "chat")
+    assert "alice" not in limiter.users
+    assert "bob" in limiter.users
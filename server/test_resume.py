@@ -0,0 +1,20 @@
+import server
+from chatlog import ChatLog
+from history import History
+
+def test_resume_from_history_does_not_skip_a_capped_channel(tmp_path, monkeypatch):
+    log = ChatLog(str(tmp_path), flush_interval=0)
+    for i in range(300):
+        log.append({"channel": "global", "from": "bob", "message": f"c{i}"})
+    for i in range(10):
+        log.append({"from": "bob", "to": "alice", "message": f"p{i}"})
+    log.close()
+    monkeypatch.setattr(server, "history", History(str(tmp_path)))
+    monkeypatch.setattr(server, "recent", server.collections.deque())
+
+    seqs, last, more = [], 0, True
+    while more:
+        events, more = server.missed_since("alice", {"global"}, last)
+        seqs += [e["seq"] for e in events]
+        last = events[-1]["seq"] if events else last
+    assert seqs == list(range(1, 311))
@@ -0,0 +1,11 @@
+from sessions import Sessions
+
+def test_malformed_tokens_are_refused():
+    s = Sessions(b"k" * 32, ttl=60)
+    stamps = {"alice": "h1"}
+    token, _ = s.issue("alice", "h1")
+    forged = token.rsplit(".", 1)[0] + ".é" * 2
+    for bad in (["x"], {"t": 1}, 42, None, "", "a.b.c.d", forged, token[:-1] + "é"):
+        assert s.check(bad, stamps.get) is None
+    assert s.check(token, stamps.get)[0] == "alice"
+    assert s.stats()["refused"] == 8
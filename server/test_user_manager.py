@@ -0,0 +1,28 @@
+import json
+
+from user_manager import JsonStore
+
+def record(name):
+    return {"uuid": name, "password": "h", "contacts": {}, "recovery_codes": []}
+
+def test_torn_journal_tail_is_dropped_before_new_writes(tmp_path):
+    path = str(tmp_path / "users.json")
+    s = JsonStore(path)
+    s.create("a", record("a"))
+    s.create("b", record("b"))
+    s.journal.close()
+    # crash halfway through appending "create c"
+    torn = json.dumps({"op": "create", "user": "c", "data": record("c")})
+    with open(path + ".journal", "a", encoding="utf-8") as f:
+        f.write(torn[:len(torn) // 2])
+
+    s = JsonStore(path)
+    assert sorted(s.users) == ["a", "b"]
+    s.create("d", record("d"))
+    s.set_contact("a", "b", True)
+    s.journal.close()
+
+    s = JsonStore(path)
+    assert sorted(s.users) == ["a", "b", "d"]
+    assert s.contacts("a") == ["b"]
+    assert s.watchers("b") == ["a"]
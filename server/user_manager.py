@@ -1,7 +1,7 @@
-
-import json, os, hashlib, random, string, uuid
+import json, os, hashlib, random, string, uuid, threading
 
 USER_FILE = "users.json"
+COMPACT_EVERY = 1000
 CHARSET = string.ascii_letters + string.digits + "-_=+@#"
 
 def _json(path, data=None):
@@ -11,7 +11,8 @@ def _json(path, data=None):
         except: return {}
     else:
         tmp = path + ".tmp"
-        json.dump(data, open(tmp, "w", encoding="utf-8"), indent=2, ensure_ascii=False)
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data if isinstance(data, str) else json.dumps(data, ensure_ascii=False))
         os.replace(tmp, path)
         return data
 
@@ -21,65 +22,187 @@ def _codes(n=10, length=16): return sorted(
     {"".join(random.choices(CHARSET, k=length)) for _ in range(n)}
 )
 
+class JsonStore:
+    # User table kept in memory. Every mutation is one appended journal line;
+    # the journal is folded into the users.json snapshot in the background
+    # every COMPACT_EVERY records. Startup loads the snapshot and replays
+    # the journal (and a rotated one left by an interrupted compaction).
+    # by_target is the reverse contact index: who has each user as a contact.
+    def __init__(self, path=USER_FILE):
+        self.path, self.journal_path = path, path + ".journal"
+        self.lock = threading.RLock()
+        self.users = _json(path)
+        self.by_target = {}
+        for u, rec in self.users.items():
+            for t in rec.get("contacts", {}): self.by_target.setdefault(t, set()).add(u)
+        old = self.journal_path + ".old"
+        self._replay(old)
+        good = self._replay(self.journal_path)
+        if good is not None:
+            # drop a torn tail so the next record doesn't get glued onto it
+            with open(self.journal_path, "r+b") as f: f.truncate(good)
+        if os.path.exists(old):
+            _json(self.path, json.dumps(self.users, ensure_ascii=False))
+            os.remove(old)
+        self.journal = open(self.journal_path, "a", encoding="utf-8")
+        self.pending, self.compacting = 0, False
+
+    def _replay(self, path):
+        # Returns the length of the journal's intact prefix.
+        if not os.path.exists(path): return None
+        good = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"): break
+                try: self._apply(json.loads(line))
+                except ValueError: break  # torn tail from a crash mid-append
+                good += len(line)
+        return good
+
+    def _apply(self, r):
+        op, u = r["op"], r["user"]
+        if op == "create":
+            self.users[u] = r["data"]
+            for t in r["data"].get("contacts", {}): self.by_target.setdefault(t, set()).add(u)
+        elif op == "delete":
+            for t in self.users.pop(u, {}).get("contacts", {}): self.by_target.get(t, set()).discard(u)
+        elif u not in self.users: return
+        elif op == "password": self.users[u]["password"] = r["hash"]
+        elif op == "contact":
+            contacts = self.users[u].setdefault("contacts", {})
+            if r["on"]:
+                contacts[r["target"]] = True
+                self.by_target.setdefault(r["target"], set()).add(u)
+            else:
+                contacts.pop(r["target"], None)
+                self.by_target.get(r["target"], set()).discard(u)
+
+    def _commit(self, r):
+        with self.lock:
+            self._apply(r)
+            self.journal.write(json.dumps(r, ensure_ascii=False) + "\n")
+            self.journal.flush()
+            self.pending += 1
+            if self.pending >= COMPACT_EVERY and not self.compacting:
+                self.compacting = True
+                threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self):
+        with self.lock:
+            self.journal.close()
+            os.replace(self.journal_path, self.journal_path + ".old")
+            self.journal = open(self.journal_path, "a", encoding="utf-8")
+            self.pending = 0
+            snapshot = json.dumps(self.users, ensure_ascii=False)
+        _json(self.path, snapshot)
+        os.remove(self.journal_path + ".old")
+        self.compacting = False
+
+    def get(self, u): return self.users.get(u)
+    def create(self, u, record): self._commit({"op": "create", "user": u, "data": record})
+    def delete(self, u): self._commit({"op": "delete", "user": u})
+    def set_password(self, u, h): self._commit({"op": "password", "user": u, "hash": h})
+    def set_contact(self, u, target, on): self._commit({"op": "contact", "user": u, "target": target, "on": on})
+    def contacts(self, u): return sorted(self.users.get(u, {}).get("contacts", {}))
+    def has_contact(self, u, target): return target in self.users.get(u, {}).get("contacts", {})
+    def watchers(self, u):
+        with self.lock: return sorted(self.by_target.get(u, ()))
+
+_store = None
+_store_lock = threading.Lock()
+
+def configure(backend="json", path=None):
+    # Select the storage backend before first use: "json" or "sqlite".
+    global _store
+    if backend == "sqlite":
+        from sqlite_store import SqliteStore, DB_FILE
+        s = SqliteStore(path or DB_FILE)
+    else:
+        s = JsonStore(path or USER_FILE)
+    with _store_lock:
+        _store = s
+    return s
+
+def store():
+    global _store
+    with _store_lock:
+        if _store is None: _store = JsonStore()
+        return _store
+
 def register_user(username, password):
-    users = _json(USER_FILE)
-    u = username.strip()
+    s, u = store(), username.strip()
     if not u or not password: return False, "Username and password required."
-    if u in users: return False, "User exists."
-    users[u] = {
-        "uuid": str(uuid.uuid4()),
-        "password": _hash(password),
-        "contacts": {},
-        "recovery_codes": _codes()
-    }
-    _json(USER_FILE, users)
-    return True, users[u]["recovery_codes"]
+    with s.lock:
+        if s.get(u): return False, "User exists."
+        codes = _codes()
+        try:
+            s.create(u, {
+                "uuid": str(uuid.uuid4()),
+                "password": _hash(password),
+                "contacts": {},
+                "recovery_codes": codes
+            })
+        except KeyError: return False, "User exists."
+    return True, codes
 
 def login_user(username, password):
-    users = _json(USER_FILE)
-    u = username.strip()
-    if u not in users: return False, "User does not exist."
-    return (True, "Login successful.") if users[u]["password"] == _hash(password) else (False, "Incorrect password.")
+    rec = store().get(username.strip())
+    if not rec: return False, "User does not exist."
+    return (True, "Login successful.") if rec["password"] == _hash(password) else (False, "Incorrect password.")
 
 def reset_password_with_code(username, code, new_pw):
-    users = _json(USER_FILE)
+    s = store()
     u, c = username.strip(), code.strip()
-    if u not in users: return False, "User does not exist."
-    if c not in users[u].get("recovery_codes", []): return False, "Invalid recovery code."
-    if not new_pw: return False, "New password required."
-    users[u]["password"] = _hash(new_pw)
-    _json(USER_FILE, users)
+    with s.lock:
+        rec = s.get(u)
+        if not rec: return False, "User does not exist."
+        if c not in rec.get("recovery_codes", []): return False, "Invalid recovery code."
+        if not new_pw: return False, "New password required."
+        s.set_password(u, _hash(new_pw))
     return True, "Password reset successfully."
 
 def delete_user_with_code(username, code):
-    users = _json(USER_FILE)
+    s = store()
     u, c = username.strip(), code.strip()
-    if u not in users: return False, "User does not exist."
-    if c not in users[u].get("recovery_codes", []): return False, "Invalid recovery code."
-    del users[u]; _json(USER_FILE, users)
+    with s.lock:
+        rec = s.get(u)
+        if not rec: return False, "User does not exist."
+        if c not in rec.get("recovery_codes", []): return False, "Invalid recovery code."
+        s.delete(u)
     return True, "Account deleted successfully."
 
 def add_contact(owner, target):
-    users = _json(USER_FILE)
+    s = store()
     o, t = owner.strip(), target.strip()
-    if o not in users: return False, "Owner does not exist."
-    if t not in users: return False, "Target user does not exist."
-    contacts = users[o].setdefault("contacts", {})
-    if t in contacts: return False, "Already in contacts."
-    contacts[t] = True; _json(USER_FILE, users)
+    with s.lock:
+        if not s.get(o): return False, "Owner does not exist."
+        if not s.get(t): return False, "Target user does not exist."
+        if s.has_contact(o, t): return False, "Already in contacts."
+        s.set_contact(o, t, True)
     return True, f"{t} added to contacts."
 
 def remove_contact(owner, target):
-    users = _json(USER_FILE)
+    s = store()
     o, t = owner.strip(), target.strip()
-    if o not in users: return False, "Owner does not exist."
-    contacts = users[o].get("contacts", {})
-    if t not in contacts: return False, "Contact not found."
-    del contacts[t]; _json(USER_FILE, users)
+    with s.lock:
+        if not s.get(o): return False, "Owner does not exist."
+        if not s.has_contact(o, t): return False, "Contact not found."
+        s.set_contact(o, t, False)
     return True, f"{t} removed from contacts."
 
+def session_stamp(username):
+    # Bound into session tokens so changing the password voids them.
+    rec = store().get(username.strip())
+    return rec and rec["password"]
+
+def user_exists(username):
+    return store().get(username.strip()) is not None
+
+def list_watchers(username):
+    # Users who have username in their contacts.
+    return store().watchers(username.strip())
+
 def list_contacts(username):
-    users = _json(USER_FILE)
-    u = username.strip()
-    if u not in users: return False, []
-    return True, sorted(users[u].get("contacts", {}).keys())
+    s, u = store(), username.strip()
+    if not s.get(u): return False, []
+    return True, s.contacts(u)